@@ -0,0 +1,188 @@
+#!/usr/bin/env python3
+
+from concurrent.futures import ProcessPoolExecutor
+import json
+import platform
+import random
+import sys
+import time
+import tracemalloc
+
+import myqoi
+
+# Size of the synthetic corpora. Posted canvases bring their own size.
+WIDTH = 512
+HEIGHT = 512
+BUFFER_BYTE_LENGTH = 4 * WIDTH * HEIGHT
+REPETITIONS = 3
+NUM_INCREMENTAL_WRITES = 100
+# Started on first use, and reused for every measurement, so that process startup isn't part of it.
+PROCESS_POOL = None
+
+
+def _repeat_to_length(pattern, length=BUFFER_BYTE_LENGTH):
+    return (pattern * (length // len(pattern) + 1))[:length]
+
+
+# Each corpus is (qoidata, width, height).
+def make_corpora():
+    rng = random.Random(42)
+    corpora = {
+        "all_zero": bytes(BUFFER_BYTE_LENGTH),
+        # The worst case mentioned in decode(): Maximal QOI_OP_RUN chunks everywhere.
+        "all_runs": _repeat_to_length(bytes([0xFD])),
+        "all_rgba": _repeat_to_length(bytes([0xFF, 12, 34, 56, 78])),
+        "random": rng.randbytes(BUFFER_BYTE_LENGTH),
+    }
+    return {name: (data, WIDTH, HEIGHT) for name, data in corpora.items()}
+
+
+def make_opcode_corpora():
+    # Each corpus consists of (almost) only one chunk type, to measure the cost per chunk.
+    return {
+        "QOI_OP_RGB": _repeat_to_length(bytes([0xFE, 1, 2, 3])),
+        "QOI_OP_RGBA": _repeat_to_length(bytes([0xFF, 1, 2, 3, 4])),
+        "QOI_OP_INDEX": _repeat_to_length(bytes(range(64))),
+        "QOI_OP_DIFF": _repeat_to_length(bytes([0x40, 0x7F, 0x55])),
+        "QOI_OP_LUMA": _repeat_to_length(bytes([0x80, 0x12, 0xBF, 0x34])),
+        "QOI_OP_RUN": _repeat_to_length(bytes([0xC0, 0xC5, 0xFD])),
+    }
+
+
+def read_canvas(qoifile):
+    # Files as posted by swallow_store, from any canvas.
+    with open(qoifile, "rb") as fp:
+        header, qoidata = myqoi.parse_header(fp.read())
+    return (qoidata, header.width, header.height)
+
+
+def _decode_incremental_writes(data, w, h):
+    data = bytearray(data)
+    decoder = myqoi.IncrementalDecoder(data, w, h)
+    rng = random.Random(1337)
+    start = time.perf_counter()
+    for _ in range(NUM_INCREMENTAL_WRITES):
+        index = rng.randrange(len(data))
+        data[index] = rng.randrange(256)
+        decoder.update([index])
+    return (time.perf_counter() - start) / NUM_INCREMENTAL_WRITES
+
+
+def _decode_parallel(data, w, h):
+    global PROCESS_POOL
+    if PROCESS_POOL is None:
+        PROCESS_POOL = ProcessPoolExecutor()
+    return myqoi.decode_pixels_parallel(data, w, h, PROCESS_POOL)
+
+
+ENTRY_POINTS = {
+    "decode": myqoi.decode,
+    "decode_fast": myqoi.decode_fast,
+    "decode_to_indices": myqoi.decode_to_indices,
+    "decode_all": myqoi.decode_all,
+    "decode_pixels_parallel": _decode_parallel,
+    "IncrementalDecoder": myqoi.IncrementalDecoder,
+}
+
+
+def measure(fn, data, w, h):
+    best = None
+    for _ in range(REPETITIONS):
+        start = time.perf_counter()
+        fn(data, w, h)
+        duration = time.perf_counter() - start
+        best = duration if best is None else min(best, duration)
+    tracemalloc.start()
+    fn(data, w, h)
+    _, peak_bytes = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return dict(
+        seconds=best,
+        mb_per_s=len(data) / best / 1e6,
+        pixels_per_s=w * h / best,
+        peak_bytes=peak_bytes,
+    )
+
+
+def run_all(corpora):
+    results = []
+    for corpus_name, (data, w, h) in corpora.items():
+        for entry_name, fn in ENTRY_POINTS.items():
+            result = dict(corpus=corpus_name, entry=entry_name)
+            result.update(measure(fn, data, w, h))
+            results.append(result)
+            print(
+                f"{corpus_name:>20} {entry_name:>20}: {result['seconds'] * 1000:9.2f} ms, {result['mb_per_s']:7.2f} MB/s, {result['pixels_per_s'] / 1e6:7.2f} Mpx/s, peak {result['peak_bytes'] / 1e6:7.2f} MB"
+            )
+        per_write = _decode_incremental_writes(data, w, h)
+        results.append(
+            dict(
+                corpus=corpus_name, entry="IncrementalDecoder.update", seconds=per_write
+            )
+        )
+        print(
+            f"{corpus_name:>20} {'IncrementalDecoder.update':>20}: {per_write * 1000:9.2f} ms per single-byte write"
+        )
+    return results
+
+
+def run_per_opcode():
+    per_opcode = dict()
+    for opcode_name, data in make_opcode_corpora().items():
+        decoded = myqoi.decode_all(data, WIDTH, HEIGHT, want_pixels=False)
+        # decode() goes on up to 3*w*h pixels, decode_fast() stops at the last visible one.
+        chunks_by_entry = dict(
+            decode=len(decoded.chunk_starts), decode_fast=len(set(decoded.indices))
+        )
+        per_opcode[opcode_name] = dict()
+        for entry_name, num_chunks in chunks_by_entry.items():
+            seconds = measure(ENTRY_POINTS[entry_name], data, WIDTH, HEIGHT)["seconds"]
+            per_opcode[opcode_name][entry_name] = dict(
+                num_chunks=num_chunks, ns_per_chunk=seconds / num_chunks * 1e9
+            )
+            print(
+                f"{opcode_name:>20} {entry_name:>20}: {seconds / num_chunks * 1e9:9.1f} ns per chunk ({num_chunks} chunks)"
+            )
+    return per_opcode
+
+
+def compare(old_file, new_file):
+    with open(old_file) as fp:
+        old_results = {(r["corpus"], r["entry"]): r for r in json.load(fp)["results"]}
+    with open(new_file) as fp:
+        new_results = {(r["corpus"], r["entry"]): r for r in json.load(fp)["results"]}
+    for key, new_result in new_results.items():
+        if key not in old_results:
+            continue
+        speedup = old_results[key]["seconds"] / new_result["seconds"]
+        print(f"{key[0]:>20} {key[1]:>26}: {speedup:6.2f}x")
+
+
+def run(outfile, canvas_files):
+    corpora = make_corpora()
+    for qoifile in canvas_files:
+        corpora[qoifile] = read_canvas(qoifile)
+    report = dict(
+        timestamp=time.time(),
+        python=platform.python_version(),
+        machine=platform.machine(),
+        results=run_all(corpora),
+        per_opcode=run_per_opcode(),
+    )
+    with open(outfile, "w") as fp:
+        json.dump(report, fp, indent=1)
+    print(f"Wrote results to {outfile}")
+
+
+if __name__ == "__main__":
+    if len(sys.argv) == 4 and sys.argv[1] == "--compare":
+        compare(sys.argv[2], sys.argv[3])
+    elif len(sys.argv) >= 2 and not sys.argv[1].startswith("-"):
+        run(sys.argv[1], sys.argv[2:])
+    else:
+        print(
+            f"USAGE: {sys.argv[0]} results.json [qoiplace_CANVAS.qoi ...]",
+            file=sys.stderr,
+        )
+        print(f"       {sys.argv[0]} --compare old.json new.json", file=sys.stderr)
+        exit(1)
@@ -1,10 +1,16 @@
 #!/usr/bin/env python3
 
+from collections import namedtuple
+import asyncio
+import concurrent.futures
 import datetime
+import hashlib
 import io
 import logging
+import os
 import time
 
+from PIL import Image
 from telegram import InputMediaDocument, Update
 from telegram.ext import (
     filters,
@@ -15,21 +21,53 @@ from telegram.ext import (
 )
 import atomic_store
 
+import canvasfile
+import historylog
+import httpcanvas
+import ingest
+import metrics
 import myqoi
 import mysecrets
-
-
-CACHED_STORE = None
+import qoidelta
+import ratelimit
+
+CACHED_REGISTRY = None
+# Decoding and PNG encoding happen here, so that handlers stay responsive in the meantime.
+RENDER_EXECUTOR = concurrent.futures.ThreadPoolExecutor(max_workers=1)
+# Same for persistence.
+COMMIT_EXECUTOR = concurrent.futures.ThreadPoolExecutor(max_workers=1)
 PLACE_TIMEOUT_SECONDS = 59
 ANCIENT_OFFSET_SECONDS = 3600 * 24
 TYPICAL_BAN_LENGTH = 3600 * 12  # Half a day should be enough to stave off the worst
 BUFFER_BYTE_LENGTH = 4 * 512 * 512
+STATE_PATH = "state.json"
+CANVAS_PATH = "canvas.bin"
+HISTORY_PATH = "history.bin"
+USERS_ARCHIVE_PATH = "users_archive.txt"
+MAIN_CANVAS_NAME = "main"
+# Every canvas gets posted this often. With several canvases, their posts are spread out over the interval.
+SWALLOW_INTERVAL_SECONDS = 60
+# Writes are applied in micro-batches, and only acknowledged once their batch is durable.
+WRITE_QUEUE_MAX_QUEUED = 10000
+WRITE_QUEUE_MAX_BATCH = 1000
+WRITE_QUEUE_WINDOW_SECONDS = 0.2
+# Optionally, serve the canvas over plain HTTP, e.g. behind a reverse proxy. Set HTTP_PORT in mysecrets.py to enable.
+HTTP_HOST = getattr(mysecrets, "HTTP_HOST", "127.0.0.1")
+HTTP_PORT = getattr(mysecrets, "HTTP_PORT", None)
+# Optionally, log all metrics every so many seconds. They are also served as /metrics if HTTP_PORT is set.
+METRICS_LOG_SECONDS = getattr(mysecrets, "METRICS_LOG_SECONDS", None)
+# Optionally, dump a cProfile of every frame render into this directory.
+PROFILE_DIR = getattr(mysecrets, "PROFILE_DIR", None)
+# Optionally, attach a third image to every post, colored by chunk type. Costs a PNG encode, but no extra decode.
+POST_OVERLAY = getattr(mysecrets, "POST_OVERLAY", False)
+# Optionally, more canvases next to the main one, see mysecrets_template.py. They share everything but their state.
+EXTRA_CANVASES = getattr(mysecrets, "CANVASES", [])
 START_TEXT = f"""\
 Hi! I have an internal buffer of {BUFFER_BYTE_LENGTH:,} bytes, that's the maximum file size of a 512×512 pixel QOI image.
 You can read up on the QOI format here: https://qoiformat.org/qoi-specification.pdf
 Send me messages like "456789 123" to set the 456789th byte to 123.
 Every minute or so, I'll post the newest QOI image here: https://t.me/qoiplace
-(Unless nothing changed.)
+(Unless nothing changed.) If you can't wait that long, send /snapshot to get the current image right away.
 
 You'll have to wait {PLACE_TIMEOUT_SECONDS} seconds between any such message. Note that this is a retaliatory rate limit: If you try to cheat and send a message before the time is up, then the timer resets to {PLACE_TIMEOUT_SECONDS} seconds. So you might want to wait {PLACE_TIMEOUT_SECONDS + 1} seconds instead, or something like that.
 
@@ -40,126 +78,611 @@ We live in a society, so please be excellent. In particular:
 
 You're very much invited to coordinate and automate. Have fun! :D
 """
-# QOI, 512 wide, 512 high, 3 channels, sRGB.
-QOI_PREAMBLE = b"qoif" + bytes([0, 0, 2, 0, 0, 0, 2, 0, 3, 0])
-QOI_EPILOGUE = bytes([0, 0, 0, 0, 0, 0, 0, 1])
+
+# Everything that differs between canvases.
+CanvasConfig = namedtuple(
+    "CanvasConfig",
+    [
+        "name",
+        "width",
+        "height",
+        "cooldown_seconds",
+        "channel_id",
+        "state_path",
+        "canvas_path",
+        "history_path",
+        "users_archive_path",
+    ],
+)
+# A rendered canvas. The version is the number of writes it includes.
+# overlay_png shows which chunk type produced each pixel, and is None unless POST_OVERLAY is enabled.
+Frame = namedtuple(
+    "Frame",
+    ["version", "qoi_file", "png_file", "pixels", "pixels_hash", "overlay_png"],
+)
+
+METRICS = metrics.Registry()
+SET_BYTE_OUTCOMES = METRICS.counter(
+    "qoiplace_set_byte_total", "Attempts to set a byte, by outcome", ["outcome"]
+)
+HANDLER_SECONDS = METRICS.histogram(
+    "qoiplace_handler_seconds",
+    "Time spent handling an update, including the wait for the group commit",
+    ["handler"],
+)
+DECODE_SECONDS = METRICS.histogram(
+    "qoiplace_decode_seconds", "Time spent bringing the decoded pixels up to date"
+)
+PNG_ENCODE_SECONDS = METRICS.histogram(
+    "qoiplace_png_encode_seconds", "Time spent encoding a frame as PNG"
+)
+GROUP_COMMIT_SECONDS = METRICS.histogram(
+    "qoiplace_group_commit_seconds", "Time spent making a batch of writes durable"
+)
+COMMIT_SECONDS = METRICS.histogram(
+    "qoiplace_commit_seconds", "Time spent persisting the full state"
+)
+COMMIT_BYTES = METRICS.counter(
+    "qoiplace_commit_bytes_total",
+    "Bytes written to disk by commits and group commits, by file",
+    ["file"],
+)
+POST_SECONDS = METRICS.histogram(
+    "qoiplace_post_seconds", "Time spent uploading a frame to the channel"
+)
+LOOP_LAG_SECONDS = METRICS.histogram(
+    "qoiplace_event_loop_lag_seconds", "How late the event loop runs a ready task"
+)
+HISTORY_LENGTH = METRICS.gauge(
+    "qoiplace_history_length",
+    "Total number of writes, to all canvases",
+    lambda: sum(
+        store.get_num_bytes_written() for store in CanvasRegistry.get_singleton().all()
+    ),
+)
+
+
+def canvas_configs():
+    configs = [
+        CanvasConfig(
+            MAIN_CANVAS_NAME,
+            512,
+            512,
+            PLACE_TIMEOUT_SECONDS,
+            mysecrets.CHANNEL_ID,
+            STATE_PATH,
+            CANVAS_PATH,
+            HISTORY_PATH,
+            USERS_ARCHIVE_PATH,
+        )
+    ]
+    for extra in EXTRA_CANVASES:
+        name = extra["name"]
+        # The name is the first word of a message, so it must not look like an offset.
+        assert name.isidentifier(), name
+        assert name not in [config.name for config in configs], name
+        configs.append(
+            CanvasConfig(
+                name,
+                extra.get("width", 512),
+                extra.get("height", 512),
+                extra.get("cooldown_seconds", PLACE_TIMEOUT_SECONDS),
+                extra["channel_id"],
+                f"{name}_{STATE_PATH}",
+                f"{name}_{CANVAS_PATH}",
+                f"{name}_{HISTORY_PATH}",
+                f"{name}_{USERS_ARCHIVE_PATH}",
+            )
+        )
+    return configs
 
 
 class Store:
-    def __init__(self):
-        print(f"===== NEW STORE!!! ===== id={id(self)}")
-        self.atomic_store = atomic_store.open("state.json", default=dict())
+    def __init__(self, config):
+        print(f"===== NEW STORE!!! ===== name={config.name} id={id(self)}")
+        self.config = config
+        self.name = config.name
+        self.width = config.width
+        self.height = config.height
+        # That's the maximum file size of a QOI image of this size.
+        self.buffer_length = 4 * config.width * config.height
+        # QOI, 3 channels, sRGB.
+        self.qoi_preamble = myqoi.encode_header(config.width, config.height)
+        self.atomic_store = atomic_store.open(config.state_path, default=dict())
         if "users_times" not in self.atomic_store.value:
             self.atomic_store.value["users_times"] = dict()
-        if "bytes_list" not in self.atomic_store.value:
-            self.atomic_store.value["bytes_list"] = [0] * BUFFER_BYTE_LENGTH
-        if "history" not in self.atomic_store.value:
-            # Tuples of (UserID, time, index, value)
-            self.atomic_store.value["history"] = []
-        self.dirty = False
+        # The canvas lives in its own binary file. Older versions kept it in state.json as "bytes_list".
+        self.canvas = canvasfile.CanvasFile(
+            config.canvas_path,
+            self.buffer_length,
+            initial_data=self.atomic_store.value.get("bytes_list"),
+        )
+        # Same for the history, which used to be a list of (UserID, time, index, value) in state.json.
+        # As long as that is still there, the migration might not have finished, so it starts over.
+        if "history" in self.atomic_store.value:
+            records = []
+            for user_id, timestamp, index, value in self.atomic_store.value["history"]:
+                user_id = int(user_id) if user_id else historylog.SYSTEM_USER_ID
+                records.append((user_id, timestamp, index, value))
+            historylog.HistoryLog.create(config.history_path, records)
+        self.history = historylog.HistoryLog(config.history_path)
+        migrated_keys = {"bytes_list", "history"} & self.atomic_store.value.keys()
+        if migrated_keys:
+            print(
+                f"Migrated {config.state_path} to {config.canvas_path} and {config.history_path}"
+            )
+            for key in migrated_keys:
+                del self.atomic_store.value[key]
+            self.atomic_store.commit()
+        # The history is durable before the canvas is. Redo writes that didn't make it into the canvas file.
+        canvas_history_len = self.atomic_store.value.get(
+            "canvas_history_len", len(self.history)
+        )
+        for record in self.history.read(canvas_history_len):
+            self.canvas[record.index] = record.value
+        if canvas_history_len < len(self.history):
+            print(f"Replayed {len(self.history) - canvas_history_len} writes")
+        # Writes only reach the canvas once their history records are durable, see make_durable().
+        # Until then, they wait here, as (index, value), in history order.
+        self.canvas_history_len = len(self.history)
+        self.unsynced_writes = []
+        self.durable_lock = asyncio.Lock()
+        # Who wrote what where, for /blame and /revert. Built in the background, see get_history_index().
+        self.history_index = historylog.HistoryIndex(self.history, self.buffer_length)
+        self.history_index_task = None
+        # Live state. self.atomic_store.value is only ever used to hold frozen snapshots while committing.
+        self.rate_limiter = ratelimit.RateLimiter(
+            self.atomic_store.value["users_times"],
+            config.users_archive_path,
+            config.cooldown_seconds,
+            ANCIENT_OFFSET_SECONDS,
+        )
+        # Every mutation bumps the version. Everything up to committed_version is known to be durable.
+        self.version = 0
+        self.committed_version = 0
+        self.commit_in_progress = False
+        self.write_queue = ingest.WriteQueue(
+            self.write_byte,
+            self.make_durable,
+            WRITE_QUEUE_MAX_QUEUED,
+            WRITE_QUEUE_MAX_BATCH,
+            WRITE_QUEUE_WINDOW_SECONDS,
+        )
+        # Decoding is lazy, and only touches what changed since the last render.
+        self.decoder = None
+        self.pending_offsets = set()
+        # Most recently rendered Frame, and the render that is currently running (if any).
+        self.frame = None
+        self.frame_task = None
+        # What the channel has last seen, so that invisible changes don't cause a new post.
+        self.published_version = self.canvas_history_len
+        self.published_pixels = None
+        self.published_hash = None
+        # The last frame that actually got posted, as (version, qoi_file), so that each post can carry a delta.
+        # Unknown after a restart, so the first post after that comes without one.
+        self.delta_base = None
+        self.post_lock = asyncio.Lock()
+        # Long-polling HTTP clients, waiting for the next write.
+        self.change_waiters = []
+
+    def freeze(self):
+        # Cheap, because all values are immutable floats, and ancient users got archived.
+        return dict(
+            users_times=dict(self.rate_limiter.users_times),
+            canvas_history_len=self.canvas_history_len,
+        )
 
-    @staticmethod
-    def get_singleton():
-        global CACHED_STORE
-        if CACHED_STORE is None:
-            CACHED_STORE = Store()
-        return CACHED_STORE
+    # Runs in COMMIT_EXECUTOR.
+    def write_frozen(self, frozen, newly_archived):
+        # The canvas only holds writes whose history is durable already, see make_durable().
+        COMMIT_BYTES.inc(self.canvas.flush(), file="canvas")
+        # Archive first: If we crash in between, the users are merely in both places.
+        COMMIT_BYTES.inc(
+            self.rate_limiter.write_archive(newly_archived), file="users_archive"
+        )
+        self.atomic_store.value = frozen
+        with COMMIT_SECONDS.time():
+            self.atomic_store.commit()
+        COMMIT_BYTES.inc(os.path.getsize(self.config.state_path), file="state")
 
-    def save_if_necessary(self):
-        if not self.dirty:
+    async def make_durable(self):
+        """
+        Group commit for all writes so far: Syncs the history, and only then applies the writes to the canvas.
+        That way, the canvas file never holds a write that a crash could still take out of the history.
+        If syncing fails, the writes stay pending, and the next call tries again.
+        """
+        async with self.durable_lock:
+            # Only the fsync may run in the executor: Writes keep getting appended in the meantime,
+            # and they must neither end up half-flushed, nor be counted as synced.
+            writes, self.unsynced_writes = self.unsynced_writes, []
+            num_records = self.history.flush()
+            try:
+                if num_records != 0:
+                    with GROUP_COMMIT_SECONDS.time():
+                        await asyncio.get_running_loop().run_in_executor(
+                            COMMIT_EXECUTOR, self.history.fsync
+                        )
+            except BaseException:
+                self.unsynced_writes[:0] = writes
+                raise
+            COMMIT_BYTES.inc(self.history.mark_synced(num_records), file="history")
+            for index, byte_value in writes:
+                self.canvas[index] = byte_value
+                self.pending_offsets.add(index)
+            self.canvas_history_len += len(writes)
+        if writes:
+            waiters, self.change_waiters = self.change_waiters, []
+            for future in waiters:
+                if not future.done():
+                    future.set_result(None)
+
+    async def commit(self):
+        if self.commit_in_progress:
             return False
-        self.dirty = False
-        self.atomic_store.commit()
+        up_to_date = self.version == self.committed_version
+        if up_to_date and not self.rate_limiter.newly_archived:
+            return False
+        self.commit_in_progress = True
+        try:
+            # Writes that are still pending (e.g. from admin commands) go onto the canvas first.
+            await self.make_durable()
+            version = self.version
+            frozen = self.freeze()
+            newly_archived = self.rate_limiter.take_newly_archived()
+            await asyncio.get_running_loop().run_in_executor(
+                COMMIT_EXECUTOR, self.write_frozen, frozen, newly_archived
+            )
+        finally:
+            self.commit_in_progress = False
+        # Anything that happened while the commit was running has a newer version, and will be committed next time.
+        self.committed_version = max(self.committed_version, version)
         return True
 
     def ban(self, user_id, ban_time):
         now = time.time()
         ban_time = max(0, ban_time)
-        self.atomic_store.value["users_times"][user_id] = now + ban_time
+        self.rate_limiter.set_time(str(user_id), now + ban_time, now)
+        self.version += 1
+
+    def reset_timeout(self, user_id):
+        self.rate_limiter.set_time(str(user_id), 0, time.time())
+        self.version += 1
 
     # number of seconds left (negative if successful, positive otherwise)
     def write_byte(self, index, byte_value, user_id) -> float:
         user_id = str(user_id)
         now = time.time()
-        if not (0 <= index < BUFFER_BYTE_LENGTH):
+        if not (0 <= index < self.buffer_length):
             return 1
-        if user_id in self.atomic_store.value["users_times"]:
-            last_write = self.atomic_store.value["users_times"][user_id]
-            remaining_wait = last_write + PLACE_TIMEOUT_SECONDS - now
-            if remaining_wait > 0.05:
-                if remaining_wait < 60:
-                    # Punish users for being too eager. Effectively reset the timer to 60 seconds.
-                    self.atomic_store.value["users_times"][user_id] = now
-                return remaining_wait
-        self.atomic_store.value["users_times"][user_id] = now
-        self.atomic_store.value["history"].append([user_id, now, index, byte_value])
-        self.atomic_store.value["bytes_list"][index] = byte_value
-        self.dirty = True
+        remaining_wait = self.rate_limiter.try_write(user_id, now)
+        if remaining_wait < 60:
+            # Either the write goes through, or the user got punished. Both change the state.
+            self.version += 1
+        if remaining_wait > 0:
+            return remaining_wait
+        self.apply_write(int(user_id), now, index, byte_value)
         return -1
 
+    # The write only shows up on the canvas after the next make_durable().
+    def apply_write(self, user_id, now, index, byte_value):
+        self.history.append(user_id, now, index, byte_value)
+        self.unsynced_writes.append((index, byte_value))
+        self.version += 1
+
+    # Returns as soon as anything is written, or after the timeout, whichever comes first.
+    async def wait_for_change(self, timeout):
+        future = asyncio.get_running_loop().create_future()
+        self.change_waiters.append(future)
+        try:
+            await asyncio.wait_for(future, timeout)
+        except asyncio.TimeoutError:
+            pass
+        finally:
+            if future in self.change_waiters:
+                self.change_waiters.remove(future)
+
     def force_null_byte(self, index) -> bool:
         now = time.time()
-        if not (0 <= index < BUFFER_BYTE_LENGTH):
+        if not (0 <= index < self.buffer_length):
             return False
-        self.atomic_store.value["users_times"][""] = now
-        self.atomic_store.value["history"].append(["", now, index, 0])
-        self.atomic_store.value["bytes_list"][index] = 0
-        self.dirty = True
+        self.rate_limiter.set_time("", now, now)
+        self.apply_write(historylog.SYSTEM_USER_ID, now, index, 0)
         return True
 
+    async def get_history_index(self):
+        """
+        Returns the HistoryIndex, including all writes so far.
+        Indexing the whole history takes a while, so the first call does that in a worker thread, and all
+        callers in the meantime wait for the same run. After that, only the newest writes need indexing.
+        """
+        if self.history_index_task is None:
+            self.history_index_task = asyncio.ensure_future(
+                asyncio.get_running_loop().run_in_executor(
+                    None, self.history_index.catch_up, self.canvas_history_len
+                )
+            )
+        try:
+            await asyncio.shield(self.history_index_task)
+        except Exception:
+            # The index might be half-built, so start from scratch next time.
+            self.history_index = historylog.HistoryIndex(
+                self.history, self.buffer_length
+            )
+            self.history_index_task = None
+            raise
+        self.history_index.catch_up(self.canvas_history_len)
+        return self.history_index
+
+    # Returns the most recent writes to that offset, as HistoryRecords.
+    async def blame(self, index, max_records=5):
+        history_index = await self.get_history_index()
+        records = []
+        for i in history_index.writes_at_offset(index):
+            if len(records) >= max_records:
+                break
+            records.append(self.history[i])
+        return records
+
+    # Undoes all writes by that user since the given time. Returns the number of bytes restored.
+    async def revert_user(self, user_id, since=0) -> int:
+        history_index = await self.get_history_index()
+        plan = history_index.revert_plan(int(user_id), since)
+        now = time.time()
+        for index, byte_value in plan.items():
+            self.apply_write(historylog.SYSTEM_USER_ID, now, index, byte_value)
+        if plan:
+            self.rate_limiter.set_time("", now, now)
+            await self.make_durable()
+        return len(plan)
+
+    # Only counts writes that made it onto the canvas.
     def get_num_bytes_written(self):
-        return len(self.atomic_store.value["history"])
+        return self.canvas_history_len
 
     def get_raw_data(self):
-        return self.atomic_store.value["bytes_list"]
+        return self.canvas.data
 
     def get_num_users(self):
-        user_stats = dict(old=0, current=0, banned=0)
-        now = time.time()
-        ancient_threshold = now - ANCIENT_OFFSET_SECONDS
-        print(f"Now processing: {self.atomic_store.value['users_times'].values()}")
-        for last_write in self.atomic_store.value["users_times"].values():
-            if last_write < ancient_threshold:
-                user_stats["old"] += 1
-            elif last_write > now:
-                user_stats["banned"] += 1
-            else:
-                user_stats["current"] += 1
-        return user_stats
+        return self.rate_limiter.stats(time.time())
 
     def str_stats(self):
-        return f"{self.get_num_bytes_written()} bytes written, known users {self.get_num_users()}"
+        return f"{self.name}: {self.get_num_bytes_written()} bytes written, known users {self.get_num_users()}, {self.write_queue.str_stats()}"
+
+    def take_snapshot(self):
+        # Returns the canvas as an immutable QOI file, and the offsets written since the previous snapshot.
+        # This is the only copy of the canvas per frame: Rendering and posting both use this very object.
+        offsets = self.pending_offsets
+        self.pending_offsets = set()
+        return (
+            myqoi.assemble_file(self.canvas.data, self.width, self.height),
+            offsets,
+        )
 
-    def render(self):
-        return myqoi.decode(self.atomic_store.value["bytes_list"], 512, 512)
+    # Runs in RENDER_EXECUTOR. Must only be given snapshots, in the order they were taken.
+    # Returns the pixels, and the chunk type overlay (or None), both as raw RGB bytes.
+    def render(self, snapshot, offsets):
+        try:
+            with DECODE_SECONDS.time():
+                if self.decoder is None:
+                    self.decoder = myqoi.IncrementalDecoder(
+                        snapshot, self.width, self.height, want_overlay=POST_OVERLAY
+                    )
+                else:
+                    self.decoder.update(offsets, snapshot)
+                overlay = self.decoder.overlay
+                return (
+                    bytes(self.decoder.pixels),
+                    None if overlay is None else bytes(overlay),
+                )
+        except BaseException:
+            # The decoder might be half-updated, so start from scratch next time.
+            self.decoder = None
+            raise
+
+    # Runs in RENDER_EXECUTOR.
+    def render_frame(self, version, qoi_file, offsets, previous_frame):
+        _, snapshot = myqoi.parse_header(qoi_file)
+        pixels, overlay = self.render(snapshot, offsets)
+        pixels_hash = hashlib.blake2b(pixels, digest_size=16).digest()
+        if previous_frame is not None and previous_frame.pixels_hash == pixels_hash:
+            # Looks exactly the same, no need to encode it again.
+            png_file = previous_frame.png_file
+        else:
+            png_file = encode_png(pixels, self.width, self.height)
+        overlay_png = None
+        if overlay is not None:
+            overlay_png = encode_png(overlay, self.width, self.height)
+        return Frame(version, qoi_file, png_file, pixels, pixels_hash, overlay_png)
+
+    async def _render_next_frame(self):
+        try:
+            version = self.canvas_history_len
+            qoi_file, offsets = self.take_snapshot()
+            args = (self.render_frame, version, qoi_file, offsets, self.frame)
+            if PROFILE_DIR is not None:
+                profile_path = os.path.join(
+                    PROFILE_DIR, f"{self.name}_frame_{version:09}.prof"
+                )
+                args = (metrics.profile_call, profile_path) + args
+            self.frame = await asyncio.get_running_loop().run_in_executor(
+                RENDER_EXECUTOR, *args
+            )
+        finally:
+            self.frame_task = None
+
+    async def get_frame(self):
+        """
+        Returns a Frame that is at least as new as the canvas at the time of the call.
+        Renders lazily, and only ever one frame at a time: Concurrent callers share the same render.
+        """
+        version = self.canvas_history_len
+        while self.frame is None or self.frame.version < version:
+            if self.frame_task is None:
+                self.frame_task = asyncio.ensure_future(self._render_next_frame())
+            await asyncio.shield(self.frame_task)
+        return self.frame
+
+
+class CanvasRegistry:
+    """
+    All canvases served by this process. They share the bot, the event loop, and the executors.
+    Messages can start with the name of a canvas; all others go to the main canvas.
+    """
+
+    def __init__(self, configs):
+        self.stores = {config.name: Store(config) for config in configs}
+
+    @staticmethod
+    def get_singleton():
+        global CACHED_REGISTRY
+        if CACHED_REGISTRY is None:
+            CACHED_REGISTRY = CanvasRegistry(canvas_configs())
+        return CACHED_REGISTRY
+
+    def main(self):
+        return self.stores[MAIN_CANVAS_NAME]
+
+    def all(self):
+        return list(self.stores.values())
+
+    def pop_canvas(self, msg_parts):
+        # Returns the Store named by the first part (or None if it isn't a canvas name), and the remaining parts.
+        if msg_parts and msg_parts[0] in self.stores:
+            return self.stores[msg_parts[0]], msg_parts[1:]
+        return None, msg_parts
+
+
+def encode_png(raw_rgb, w, h):
+    with PNG_ENCODE_SECONDS.time():
+        img = Image.frombuffer("RGB", (w, h), raw_rgb, "raw", "RGB", 0, 1)
+        buf = io.BytesIO()
+        img.save(buf, format="PNG")
+        return buf.getvalue()
+
+
+def frame_media(store, frame, delta=None):
+    timestamp_str = datetime.datetime.now().strftime("%Y%m%d_%H%M%S")
+    if store.name != MAIN_CANVAS_NAME:
+        timestamp_str = f"{store.name}_{timestamp_str}"
+    qoi_doc = InputMediaDocument(
+        frame.qoi_file, filename=f"qoiplace_{timestamp_str}.qoi"
+    )
+    png_doc = InputMediaDocument(
+        frame.png_file, filename=f"qoiplace_{timestamp_str}.png"
+    )
+    media = [qoi_doc, png_doc]
+    if delta is not None:
+        media.append(
+            InputMediaDocument(delta, filename=f"qoiplace_{timestamp_str}.qoidelta")
+        )
+    if frame.overlay_png is not None:
+        media.append(
+            InputMediaDocument(
+                frame.overlay_png, filename=f"qoiplace_{timestamp_str}_chunks.png"
+            )
+        )
+    return media
+
+
+# Runs in RENDER_EXECUTOR, because reading the history can take a while after a busy minute.
+def make_frame_delta(store, base_version, base_file, frame):
+    offsets = {
+        record.index for record in store.history.read(base_version, frame.version)
+    }
+    return qoidelta.make_delta(
+        base_version, base_file, frame.version, frame.qoi_file, offsets
+    )
 
 
 async def swallow_store(context: ContextTypes.DEFAULT_TYPE):
     store = context.job.data
-    if not store.save_if_necessary():
+    await store.commit()
+    if store.get_num_bytes_written() == store.published_version:
         # Nothing changed, no need to make a post about it.
         return
+    # Overlapping ticks must not post the same frame twice, or base a delta on a post that might still fail.
+    async with store.post_lock:
+        await post_frame(context, store)
+
+
+async def post_frame(context: ContextTypes.DEFAULT_TYPE, store):
     # Something changed! Let's post about it:
-    now = time.time()
-    timestamp_str = datetime.datetime.fromtimestamp(now).strftime("%Y%m%d_%H%M%S")
-    qoi_file = QOI_PREAMBLE + bytes(store.get_raw_data()) + QOI_EPILOGUE
-    img = store.render()
-    buf = io.BytesIO()
-    img.save(buf, format="PNG")
-    png_file = buf.getvalue()
-    qoi_doc = InputMediaDocument(qoi_file, filename=f"qoiplace_{timestamp_str}.qoi")
-    png_doc = InputMediaDocument(png_file, filename=f"qoiplace_{timestamp_str}.png")
-    await context.bot.send_media_group(
-        chat_id=mysecrets.CHANNEL_ID,
-        media=[qoi_doc, png_doc],
-        caption=f"Whoop whoop! New frame: {store.get_num_users()} wrote a total of {store.get_num_bytes_written()} bytes. This is the result.",
-        disable_notification=True,
+    frame = await store.get_frame()
+    if frame.version <= store.published_version:
+        # Someone else already posted this frame, e.g. an overlapping tick.
+        return
+    if frame.pixels_hash == store.published_hash:
+        # Bytes changed, but the image looks exactly the same. No need to bother the channel.
+        print("Frame is visually unchanged, skipping this post")
+        store.published_version = frame.version
+        return
+    if store.published_pixels is None:
+        num_changed = store.width * store.height
+        bbox = (0, 0, store.width, store.height)
+    else:
+        num_changed, bbox = await asyncio.get_running_loop().run_in_executor(
+            RENDER_EXECUTOR,
+            myqoi.diff_pixels,
+            store.published_pixels,
+            frame.pixels,
+            store.width,
+            store.height,
+        )
+    x0, y0, x1, y1 = bbox
+    delta = None
+    if store.delta_base is not None:
+        base_version, base_file = store.delta_base
+        delta = await asyncio.get_running_loop().run_in_executor(
+            RENDER_EXECUTOR, make_frame_delta, store, base_version, base_file, frame
+        )
+    with POST_SECONDS.time():
+        await context.bot.send_media_group(
+            chat_id=store.config.channel_id,
+            media=frame_media(store, frame, delta),
+            caption=f"Whoop whoop! New frame: {store.get_num_users()} wrote a total of {store.get_num_bytes_written()} bytes. This is the result. {num_changed:,} pixels changed, between ({x0}, {y0}) and ({x1 - 1}, {y1 - 1}).",
+            disable_notification=True,
+        )
+    # Only now the channel has actually seen it. If the upload failed, the next tick tries again, with the same base.
+    store.published_version = frame.version
+    store.published_pixels = frame.pixels
+    store.published_hash = frame.pixels_hash
+    store.delta_base = (frame.version, frame.qoi_file)
+
+
+async def log_metrics(_context: ContextTypes.DEFAULT_TYPE):
+    print(f"Metrics: {METRICS.summary_line()}")
+
+
+def instrumented(handler):
+    async def wrapper(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+        with HANDLER_SECONDS.time(handler=handler.__name__):
+            await handler(update, context)
+
+    return wrapper
+
+
+async def snapshot(update: Update, _context: ContextTypes.DEFAULT_TYPE) -> None:
+    """Sends the current canvas right away."""
+    registry = CanvasRegistry.get_singleton()
+    store, _ = registry.pop_canvas(update.message.text.split(" ")[1:])
+    store = store or registry.main()
+    frame = await store.get_frame()
+    await update.message.reply_media_group(
+        media=frame_media(store, frame),
+        caption=f"This is the canvas after {frame.version:,} writes.",
     )
 
 
 async def start(update: Update, _context: ContextTypes.DEFAULT_TYPE) -> None:
     """Sends explanation on how to use the bot."""
-    await update.message.reply_text(START_TEXT)
+    text = START_TEXT
+    extra_stores = CanvasRegistry.get_singleton().all()[1:]
+    if extra_stores:
+        example = extra_stores[0].name
+        text += f'\nThere are other canvases, too. Put the name in front to write there, like "{example} 1234 56", or "/snapshot {example}":\n'
+        for store in extra_stores:
+            text += f"- {store.name}: {store.width}×{store.height} pixels, {store.buffer_length:,} bytes, {store.config.cooldown_seconds} seconds between messages\n"
+    await update.message.reply_text(text)
 
 
 async def admin(update: Update, _context: ContextTypes.DEFAULT_TYPE) -> None:
@@ -168,8 +691,12 @@ async def admin(update: Update, _context: ContextTypes.DEFAULT_TYPE) -> None:
         """
 /admin
 /ban USER_ID [TIME_SECONDS]
+/blame [CANVAS] OFFSET
+/null [CANVAS] OFFSET
+/revert [CANVAS] USER_ID [SINCE_UNIX_TIMESTAMP]
 /sigh
 /stats
+Without CANVAS, /blame and /null mean the main canvas, and /revert means all of them. /ban and /sigh always apply to all canvases.
 """
     )
 
@@ -177,16 +704,15 @@ async def admin(update: Update, _context: ContextTypes.DEFAULT_TYPE) -> None:
 async def stats(update: Update, _context: ContextTypes.DEFAULT_TYPE) -> None:
     if update.effective_user.id != mysecrets.OWNER_ID:
         return
-    await update.message.reply_text(
-        f"Current stats: {Store.get_singleton().str_stats()}"
-    )
+    all_stats = [store.str_stats() for store in CanvasRegistry.get_singleton().all()]
+    await update.message.reply_text("Current stats:\n" + "\n".join(all_stats))
 
 
 async def sigh(update: Update, _context: ContextTypes.DEFAULT_TYPE) -> None:
     if update.effective_user.id != mysecrets.OWNER_ID:
         return
-    store = Store.get_singleton()
-    store.atomic_store.value["users_times"][mysecrets.OWNER_ID] = 0
+    for store in CanvasRegistry.get_singleton().all():
+        store.reset_timeout(mysecrets.OWNER_ID)
     await update.message.reply_text("Reset")
 
 
@@ -195,10 +721,13 @@ async def null(update: Update, _context: ContextTypes.DEFAULT_TYPE) -> None:
         return
     success = False
     exception = None
-    store = Store.get_singleton()
+    registry = CanvasRegistry.get_singleton()
+    store, msg_parts = registry.pop_canvas(update.message.text.split(" ")[1:])
+    store = store or registry.main()
     try:
-        index = int(update.message.text.split(" ")[1])
+        index = int(msg_parts[0])
         store.force_null_byte(index)
+        await store.make_durable()
         success = True
     except BaseException as e:
         exception = e
@@ -208,6 +737,61 @@ async def null(update: Update, _context: ContextTypes.DEFAULT_TYPE) -> None:
         await update.message.reply_text(f"Failed! Error: {exception}")
 
 
+async def blame(update: Update, _context: ContextTypes.DEFAULT_TYPE) -> None:
+    if update.effective_user.id != mysecrets.OWNER_ID:
+        return
+    registry = CanvasRegistry.get_singleton()
+    store, msg_parts = registry.pop_canvas(update.message.text.split(" ")[1:])
+    store = store or registry.main()
+    try:
+        index = int(msg_parts[0])
+        records = await store.blame(index)
+    except BaseException as e:
+        await update.message.reply_text(f"Failed! Error: {e}")
+        return
+    if not records:
+        await update.message.reply_text(f"Nobody ever wrote to {index}.")
+        return
+    lines = [
+        f"{datetime.datetime.fromtimestamp(r.time):%Y-%m-%d %H:%M:%S} user {r.user_id} wrote {r.value}"
+        for r in records
+    ]
+    await update.message.reply_text(
+        f"Most recent writes to {index}:\n" + "\n".join(lines)
+    )
+
+
+async def revert(update: Update, _context: ContextTypes.DEFAULT_TYPE) -> None:
+    if update.effective_user.id != mysecrets.OWNER_ID:
+        return
+    if update.message is None or update.message.text is None:
+        return  # Don't consider Updates that don't stem from a text message.
+    msg_parts = update.message.text.split(" ")[1:]  # Split, and remove "/revert" prefix
+    registry = CanvasRegistry.get_singleton()
+    store, msg_parts = registry.pop_canvas(msg_parts)
+    stores = registry.all() if store is None else [store]
+    if len(msg_parts) not in [1, 2]:
+        await update.message.reply_text(
+            f"Need only 1 or 2 parts `/revert [CANVAS] USER_ID [SINCE_UNIX_TIMESTAMP]` , instead got {len(msg_parts)}<<"
+        )
+        return
+    try:
+        user_id = int(msg_parts[0])
+        since = float(msg_parts[1]) if len(msg_parts) == 2 else 0
+    except ValueError:
+        await update.message.reply_text(
+            f"Couldn't convert some part to a number?! >>{msg_parts}<<"
+        )
+        return
+    lines = []
+    for store in stores:
+        num_reverted = await store.revert_user(user_id, since)
+        # One commit for the whole batch. The next frame re-renders everything at once.
+        await store.commit()
+        lines.append(f"Reverted {num_reverted} bytes. New stats: {store.str_stats()}")
+    await update.message.reply_text("\n".join(lines))
+
+
 async def ban(update: Update, _context: ContextTypes.DEFAULT_TYPE) -> None:
     if update.effective_user.id != mysecrets.OWNER_ID:
         return
@@ -230,17 +814,19 @@ async def ban(update: Update, _context: ContextTypes.DEFAULT_TYPE) -> None:
             f"Need only 1 or 2 parts `/ban USER_ID [TIME_SECONDS]` , instead got {len(int_parts)}<<"
         )
         return
-    store = Store.get_singleton()
-    store.ban(*int_parts)
-    await update.message.reply_text(
-        f"User banned. New stats: {Store.get_singleton().str_stats()}"
-    )
+    all_stats = []
+    for store in CanvasRegistry.get_singleton().all():
+        store.ban(*int_parts)
+        all_stats.append(store.str_stats())
+    await update.message.reply_text("User banned. New stats:\n" + "\n".join(all_stats))
 
 
 async def set_byte(update: Update, _context: ContextTypes.DEFAULT_TYPE) -> None:
     if update.message is None or update.message.text is None:
         return  # Don't consider Updates that don't stem from a text message.
-    msg_parts = update.message.text.split(" ")
+    registry = CanvasRegistry.get_singleton()
+    store, msg_parts = registry.pop_canvas(update.message.text.split(" "))
+    store = store or registry.main()
     int_parts = None
     if len(msg_parts) == 2 and all(len(p) < 25 for p in msg_parts):
         try:
@@ -248,33 +834,58 @@ async def set_byte(update: Update, _context: ContextTypes.DEFAULT_TYPE) -> None:
         except ValueError:
             int_parts = None
     if int_parts is None:
+        SET_BYTE_OUTCOMES.inc(outcome="invalid")
         await update.message.reply_text(
             'I can\'t interpret that. Just write something like "456789 123" (without the quotation marks) to set the 456789th byte to 123. See /start for more explanation.'
         )
         return
     index, value = int_parts
-    if not (0 <= index < BUFFER_BYTE_LENGTH):
+    if not (0 <= index < store.buffer_length):
+        SET_BYTE_OUTCOMES.inc(outcome="invalid")
         await update.message.reply_text(
-            f"The first number is the byte offset of the buffer, which has length {BUFFER_BYTE_LENGTH:,}. That means that {index} won't work. See /start for more explanation."
+            f"The first number is the byte offset of the buffer, which has length {store.buffer_length:,}. That means that {index} won't work. See /start for more explanation."
         )
         return
     if not (0 <= value < 256):
+        SET_BYTE_OUTCOMES.inc(outcome="invalid")
         await update.message.reply_text(
             f"The second number is the new byte value you want to write, which must be between 0 and 255 inclusively. That means that {value} won't work. See /start for more explanation."
         )
         return
-    store = Store.get_singleton()
-    remaining_wait = store.write_byte(index, value, update.effective_user.id)
+    try:
+        remaining_wait = await store.write_queue.submit(
+            (index, value, update.effective_user.id)
+        )
+    except ingest.QueueFull:
+        SET_BYTE_OUTCOMES.inc(outcome="overwhelmed")
+        await update.message.reply_text(
+            "Sorry, I'm a bit overwhelmed right now. Please try again in a few seconds; this doesn't count against your timeout."
+        )
+        return
     if remaining_wait > 0:
+        SET_BYTE_OUTCOMES.inc(outcome="rate_limited")
         await update.message.reply_text(
-            f"Sorry, you should have waited {remaining_wait} more seconds. Timeout has been reset to at least {PLACE_TIMEOUT_SECONDS}."
+            f"Sorry, you should have waited {remaining_wait} more seconds. Timeout has been reset to at least {store.config.cooldown_seconds}."
         )
     else:
+        SET_BYTE_OUTCOMES.inc(outcome="accepted")
         await update.message.reply_text(
             f"Done, {update.effective_user.first_name}! You should see the result in the common channel soon."
         )
 
 
+async def post_init(application: Application) -> None:
+    registry = CanvasRegistry.get_singleton()
+    for store in registry.all():
+        application.create_task(store.write_queue.run())
+        # Start indexing right away, so that the first /blame or /revert doesn't have to wait as long.
+        application.create_task(store.get_history_index())
+    application.create_task(metrics.monitor_loop_lag(LOOP_LAG_SECONDS))
+    if HTTP_PORT is not None:
+        server = httpcanvas.CanvasServer(registry.stores, MAIN_CANVAS_NAME, METRICS)
+        await server.start(HTTP_HOST, HTTP_PORT)
+
+
 def run() -> None:
     # Enable logging
     logging.basicConfig(
@@ -283,21 +894,40 @@ def run() -> None:
     )
 
     # Create the Application and pass it your bot's token.
-    application = Application.builder().token(mysecrets.TOKEN).build()
+    # Updates must be handled concurrently, so that the writes of many users can share a batch.
+    application = (
+        Application.builder()
+        .token(mysecrets.TOKEN)
+        .concurrent_updates(True)
+        .post_init(post_init)
+        .build()
+    )
 
     # on different commands - answer in Telegram
     application.add_handler(CommandHandler(["start", "help"], start))
-    application.add_handler(CommandHandler("admin", admin))
-    application.add_handler(CommandHandler("stats", stats))
-    application.add_handler(CommandHandler("sigh", sigh))
-    application.add_handler(CommandHandler("ban", ban))
-    application.add_handler(CommandHandler("null", null))
-    application.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, set_byte))
+    application.add_handler(CommandHandler("snapshot", instrumented(snapshot)))
+    application.add_handler(CommandHandler("admin", instrumented(admin)))
+    application.add_handler(CommandHandler("stats", instrumented(stats)))
+    application.add_handler(CommandHandler("sigh", instrumented(sigh)))
+    application.add_handler(CommandHandler("ban", instrumented(ban)))
+    application.add_handler(CommandHandler("null", instrumented(null)))
+    application.add_handler(CommandHandler("blame", instrumented(blame)))
+    application.add_handler(CommandHandler("revert", instrumented(revert)))
+    application.add_handler(
+        MessageHandler(filters.TEXT & ~filters.COMMAND, instrumented(set_byte))
+    )
 
     job_queue = application.job_queue
-    store = Store.get_singleton()
-    print(f"Starting with {store.str_stats()}")
-    job_queue.run_repeating(swallow_store, interval=60, first=10, data=store)
+    stores = CanvasRegistry.get_singleton().all()
+    for i, store in enumerate(stores):
+        print(f"Starting with {store.str_stats()}")
+        # Staggered, so that the renders don't all compete for RENDER_EXECUTOR at the same time.
+        first = 10 + i * SWALLOW_INTERVAL_SECONDS / len(stores)
+        job_queue.run_repeating(
+            swallow_store, interval=SWALLOW_INTERVAL_SECONDS, first=first, data=store
+        )
+    if METRICS_LOG_SECONDS is not None:
+        job_queue.run_repeating(log_metrics, interval=METRICS_LOG_SECONDS)
 
     # Run the bot until the user presses Ctrl-C
     application.run_polling(allowed_updates=Update.ALL_TYPES)
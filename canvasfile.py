@@ -0,0 +1,73 @@
+#!/bin/false
+# This is a library.
+
+import mmap
+import os
+import threading
+
+
+class CanvasFile:
+    """
+    A fixed-size binary file that holds the raw canvas bytes, accessed through mmap.
+    Writes go straight into the mapping; flush() only writes back the pages between the first and last change,
+    and returns how many bytes that was.
+    """
+
+    def __init__(self, path, length, initial_data=None):
+        self.path = path
+        self.length = length
+        if not os.path.exists(path):
+            CanvasFile.create(path, length, initial_data)
+        self.fp = open(path, "r+b")
+        actual_length = os.fstat(self.fp.fileno()).st_size
+        if actual_length != length:
+            raise ValueError(
+                f"Canvas file {path} has {actual_length} bytes, expected {length}"
+            )
+        self.mmap = mmap.mmap(self.fp.fileno(), length)
+        self.data = memoryview(self.mmap)
+        # Range of offsets written since the last flush, or None. flush() may run in another thread.
+        self.dirty = None
+        self.dirty_lock = threading.Lock()
+
+    @staticmethod
+    def create(path, length, initial_data=None):
+        # Write to a temporary file first, so that a crash never leaves a half-initialized canvas behind.
+        tmp_path = f"{path}.tmp"
+        with open(tmp_path, "wb") as fp:
+            if initial_data is None:
+                fp.truncate(length)
+            else:
+                assert len(initial_data) == length, (len(initial_data), length)
+                fp.write(bytes(initial_data))
+            fp.flush()
+            os.fsync(fp.fileno())
+        os.replace(tmp_path, path)
+
+    def __setitem__(self, index, byte_value):
+        self.data[index] = byte_value
+        with self.dirty_lock:
+            if self.dirty is None:
+                self.dirty = (index, index + 1)
+            else:
+                start, stop = self.dirty
+                if not start <= index < stop:
+                    self.dirty = (min(start, index), max(stop, index + 1))
+
+    def __getitem__(self, index):
+        return self.data[index]
+
+    def __len__(self):
+        return self.length
+
+    def flush(self):
+        with self.dirty_lock:
+            if self.dirty is None:
+                return 0
+            start, stop = self.dirty
+            self.dirty = None
+        # msync wants a page-aligned start, and writes back whole pages anyway.
+        start -= start % mmap.PAGESIZE
+        stop = min(stop - stop % -mmap.PAGESIZE, self.length)
+        self.mmap.flush(start, stop - start)
+        return stop - start
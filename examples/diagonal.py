@@ -27,22 +27,23 @@ def cmds_to_make(qoidata, index, value):
 
 def determine_commands(qoifile_path):
     with open(qoifile_path, "rb") as fp:
-        qoidata_with_header = bytearray(fp.read())
-    qoidata = qoidata_with_header[14:-8]
+        _, qoidata = myqoi.parse_header(bytearray(fp.read()))
     assert len(qoidata) == 512 * 512 * 4, len(qoidata)
     write_commands = []
     for i in range(10):
-        current_indices = myqoi.decode_to_indices(qoidata, 512, 512)
+        current_indices = myqoi.decode_all(
+            qoidata, 512, 512, want_pixels=False, want_chunk_starts=False
+        ).indices
         offset = (XSTART - i) + 512 * (YSTART + i)
         assert 0 <= offset < 512 * 512
         index_start = current_indices[offset]
-        print(f"before: {qoidata[index_start : index_start + 5]}")
+        print(f"before: {bytes(qoidata[index_start : index_start + 5])}")
         write_commands.extend(cmds_to_make(qoidata, index_start, 0xFE))
         write_commands.extend(cmds_to_make(qoidata, index_start + 1, COLOR[0]))
         write_commands.extend(cmds_to_make(qoidata, index_start + 2, COLOR[1]))
         write_commands.extend(cmds_to_make(qoidata, index_start + 3, COLOR[2]))
         write_commands.extend(cmds_to_make(qoidata, index_start + 4, 0x40))
-        print(f"after: {qoidata[index_start : index_start + 5]}")
+        print(f"after: {bytes(qoidata[index_start : index_start + 5])}")
         # Need to re-evaluate indices, because everything afterwards might have just shifted.
     return write_commands
 
@@ -0,0 +1,304 @@
+#!/usr/bin/env python3
+
+import bisect
+import inspect
+import os
+import sys
+
+from PIL import Image
+
+# Hacky way to use existing "myqoi" implementation:
+currentdir = os.path.dirname(os.path.abspath(inspect.getfile(inspect.currentframe())))
+parentdir = os.path.dirname(currentdir)
+sys.path.insert(0, parentdir)
+import myqoi
+
+VERBOSE = True
+# A window is a few consecutive chunks that get re-encoded together. The re-encoding may be a bit longer.
+MAX_WINDOW_CHUNKS = 4
+MAX_EXTRA_BYTES = 4
+# Upper bound on the number of re-encodings considered per window, and how many get decoded for real per pixel.
+MAX_ENCODINGS_PER_WINDOW = 2000
+MAX_TRIALS_PER_PIXEL = 16
+# Before decoding a candidate for real, check this many pixels after it, which rules out most bad candidates cheaply.
+QUICK_CHECK_PIXELS = 4096
+# Target pixels more transparent than this are "don't care".
+ALPHA_THRESHOLD = 128
+
+
+def _hash(rgba):
+    r, g, b, a = rgba
+    return (r * 3 + g * 5 + b * 7 + a * 11) % 64
+
+
+def _wrap(delta):
+    return (delta + 128) % 256 - 128
+
+
+def single_pixel_encodings(rgba, table, last):
+    """Yields all chunks that produce exactly this one pixel, given the decoder state."""
+    if table[_hash(rgba)] == rgba:
+        yield bytes([_hash(rgba)])
+    if rgba[3] == last[3]:
+        dr, dg, db = (_wrap(rgba[i] - last[i]) for i in range(3))
+        if all(-2 <= d <= 1 for d in (dr, dg, db)):
+            yield bytes([0x40 | (dr + 2) << 4 | (dg + 2) << 2 | (db + 2)])
+        if -32 <= dg <= 31 and -8 <= dr - dg <= 7 and -8 <= db - dg <= 7:
+            yield bytes([0x80 | (dg + 32), (dr - dg + 8) << 4 | (db - dg + 8)])
+        yield bytes([0xFE, rgba[0], rgba[1], rgba[2]])
+    yield bytes([0xFF, rgba[0], rgba[1], rgba[2], rgba[3]])
+
+
+def window_encodings(colors, table, last, max_length):
+    """
+    Returns all byte strings of at most max_length bytes that decode to exactly these colors (RGB tuples),
+    starting from the given decoder state. Alpha always stays whatever it was before.
+    """
+    results = []
+
+    def visit(pos, table, last, prefix):
+        if len(prefix) > max_length or len(results) >= MAX_ENCODINGS_PER_WINDOW:
+            return
+        if pos == len(colors):
+            results.append(prefix)
+            return
+        rgba = colors[pos] + (last[3],)
+        if rgba == last:
+            run_length = 1
+            while (
+                pos + run_length < len(colors)
+                and run_length < 62
+                and colors[pos + run_length] == colors[pos]
+            ):
+                run_length += 1
+            # Trying every possible run length would explode. These are the ones that tend to matter.
+            for m in sorted({run_length, run_length - 1, 1}, reverse=True):
+                if m > 0:
+                    visit(pos + m, table, last, prefix + bytes([0xC0 | (m - 1)]))
+        for chunk in single_pixel_encodings(rgba, table, last):
+            new_table = list(table)
+            new_table[_hash(rgba)] = rgba
+            visit(pos + 1, new_table, rgba, prefix + chunk)
+
+    visit(0, list(table), last, b"")
+    return results
+
+
+class Planner:
+    """
+    Plans byte writes that turn the current canvas into the target, and leave all other pixels intact.
+
+    Works greedily in stream order: For each wrong pixel, a few consecutive chunks around it get re-encoded,
+    preferring encodings that differ from the current bytes in as few places as possible, e.g. by reusing
+    QOI_OP_INDEX/DIFF/LUMA. Each candidate is checked for real with an IncrementalDecoder, which only re-decodes
+    until the stream resynchronizes, and is only taken if it doesn't damage any pixel outside the target.
+    """
+
+    def __init__(self, qoidata, target, w, h):
+        # target: dict from pixel index to RGB tuple
+        self.original = bytes(qoidata)
+        self.qoidata = bytearray(qoidata)
+        self.w = w
+        self.h = h
+        self.target = target
+        self.decoder = myqoi.IncrementalDecoder(self.qoidata, w, h)
+        self.desired = bytearray(self.decoder.pixels)
+        for px, rgb in target.items():
+            self.desired[3 * px : 3 * px + 3] = bytes(rgb)
+
+    def _pixel(self, px):
+        return tuple(self.decoder.pixels[3 * px : 3 * px + 3])
+
+    def _window_around(self, px):
+        """Returns (state, Chunk) for the chunk before the one that produces px, and a few chunks from there on."""
+        checkpoint_pxs = [state[1] for state in self.decoder.checkpoints]
+        i = bisect.bisect_right(checkpoint_pxs, px) - 1
+        state = self.decoder.checkpoints[i] if i >= 0 else None
+        stream = myqoi.ChunkStream(self.qoidata, self.w, self.h, state=state)
+        previous = None
+        window = []
+        while True:
+            state = stream.get_state()
+            chunk = next(stream, None)
+            if chunk is None:
+                break
+            if window or chunk.px_start + chunk.px_count > px:
+                window.append((state, chunk))
+                if len(window) >= MAX_WINDOW_CHUNKS:
+                    break
+            else:
+                previous = (state, chunk)
+        if previous is not None:
+            window.insert(0, previous)
+        return window
+
+    def _quick_check(self, state, offset, new_bytes):
+        """Returns whether writing new_bytes at offset leaves the next few non-target pixels intact."""
+        old_bytes = bytes(self.qoidata[offset : offset + len(new_bytes)])
+        self.qoidata[offset : offset + len(new_bytes)] = new_bytes
+        max_pixels = min(state[1] + QUICK_CHECK_PIXELS, self.w * self.h)
+        stream = myqoi.ChunkStream(
+            self.qoidata, self.w, self.h, state=state, max_pixels=max_pixels
+        )
+        intact = True
+        for chunk in stream:
+            rgb = bytes(chunk.rgba[:3])
+            for p in range(
+                chunk.px_start, min(chunk.px_start + chunk.px_count, max_pixels)
+            ):
+                if p not in self.target and self.desired[3 * p : 3 * p + 3] != rgb:
+                    intact = False
+                    break
+            if not intact:
+                break
+        self.qoidata[offset : offset + len(old_bytes)] = old_bytes
+        return intact
+
+    def _trial(self, offset, new_bytes):
+        """Tries writing new_bytes at offset. Returns (improvement, damage), and undoes the write."""
+        old_bytes = bytes(self.qoidata[offset : offset + len(new_bytes)])
+        changed = [offset + i for i, b in enumerate(new_bytes) if old_bytes[i] != b]
+        before = bytes(self.decoder.pixels)
+        self.qoidata[offset : offset + len(new_bytes)] = new_bytes
+        px_start, px_end = self.decoder.update(changed)
+        improvement, damage = self._score(before, px_start, px_end)
+        self.qoidata[offset : offset + len(old_bytes)] = old_bytes
+        self.decoder.update(changed)
+        return improvement, damage
+
+    def _score(self, before, px_start, px_end):
+        after = self.decoder.pixels
+        desired = self.desired
+        improvement = 0
+        damage = 0
+        block = 3 * 64
+        for block_start in range(3 * px_start, 3 * px_end, block):
+            block_end = min(block_start + block, 3 * px_end)
+            if before[block_start:block_end] == after[block_start:block_end]:
+                continue
+            for i in range(block_start, block_end, 3):
+                was_ok = before[i : i + 3] == desired[i : i + 3]
+                is_ok = after[i : i + 3] == desired[i : i + 3]
+                if was_ok and not is_ok and i // 3 not in self.target:
+                    damage += 1
+                improvement += is_ok - was_ok
+        return improvement, damage
+
+    def _candidates(self, px):
+        """Yields (num_writes, offset, new_bytes) for re-encodings of all windows that contain px."""
+        window = self._window_around(px)
+        # Windows must contain px, and may start one chunk early.
+        for first in range(len(window)):
+            state, first_chunk = window[first]
+            if first_chunk.px_start > px:
+                break
+            for last in range(first, len(window)):
+                last_chunk = window[last][1]
+                px_end = last_chunk.px_start + last_chunk.px_count
+                if px_end <= px or px_end > self.w * self.h:
+                    continue
+                offset = first_chunk.data_offset
+                length = last_chunk.data_offset + last_chunk.length - offset
+                colors = [
+                    tuple(self.desired[3 * p : 3 * p + 3])
+                    for p in range(first_chunk.px_start, px_end)
+                ]
+                max_length = min(length + MAX_EXTRA_BYTES, len(self.qoidata) - offset)
+                old_bytes = bytes(self.qoidata[offset : offset + max_length])
+                for new_bytes in window_encodings(
+                    colors, state[2], state[3], max_length
+                ):
+                    num_writes = sum(a != b for a, b in zip(new_bytes, old_bytes))
+                    if num_writes > 0:
+                        yield (
+                            num_writes,
+                            len(new_bytes) != length,
+                            offset,
+                            new_bytes,
+                            state,
+                        )
+
+    def _fix_pixel(self, px):
+        # Fewest writes first. On ties, prefer keeping the length, which resynchronizes quickly.
+        # Changing the length shifts everything afterwards, which is only fine within uniform areas.
+        candidates = sorted(set(self._candidates(px)))
+        num_trials = 0
+        for _, _, offset, new_bytes, state in candidates:
+            if num_trials >= MAX_TRIALS_PER_PIXEL:
+                break
+            if not self._quick_check(state, offset, new_bytes):
+                continue
+            num_trials += 1
+            improvement, damage = self._trial(offset, new_bytes)
+            if damage == 0 and improvement > 0:
+                changed = [
+                    offset + i
+                    for i, b in enumerate(new_bytes)
+                    if self.qoidata[offset + i] != b
+                ]
+                self.qoidata[offset : offset + len(new_bytes)] = new_bytes
+                self.decoder.update(changed)
+                return True
+        return False
+
+    def plan(self):
+        """Returns the list of (offset, value) writes, and the number of target pixels that couldn't be reached."""
+        num_unreachable = 0
+        for px in sorted(self.target):
+            if self._pixel(px) == self.target[px]:
+                continue
+            if not self._fix_pixel(px):
+                num_unreachable += 1
+                if VERBOSE:
+                    print(f"Can't reach pixel ({px % self.w}, {px // self.w})")
+        writes = [
+            (offset, value)
+            for offset, (old, value) in enumerate(zip(self.original, self.qoidata))
+            if old != value
+        ]
+        return writes, num_unreachable
+
+
+def load_target(pngfile, x, y, w, h):
+    img = Image.open(pngfile).convert("RGBA")
+    target = dict()
+    for dy in range(img.height):
+        for dx in range(img.width):
+            r, g, b, a = img.getpixel((dx, dy))
+            if a >= ALPHA_THRESHOLD and 0 <= x + dx < w and 0 <= y + dy < h:
+                target[(x + dx) + w * (y + dy)] = (r, g, b)
+    return target
+
+
+def run(qoifile_path, pngfile, x, y, canvas=None):
+    # The size comes from the posted file, so this works for any canvas.
+    with open(qoifile_path, "rb") as fp:
+        header, qoidata = myqoi.parse_header(fp.read())
+    w, h = header.width, header.height
+    assert len(qoidata) == w * h * 4, len(qoidata)
+    target = load_target(pngfile, x, y, w, h)
+    writes, num_unreachable = Planner(qoidata, target, w, h).plan()
+    print(
+        f"Planned {len(writes)} writes for {len(target)} target pixels, {num_unreachable} unreachable."
+    )
+    # Only needed for actually sending the commands, so planning works without telethon.
+    import multi
+
+    # Writes to other canvases start with the canvas name.
+    prefix = "" if canvas is None else f"{canvas} "
+    multi.run_commands([f"{prefix}{offset} {value}" for offset, value in writes])
+
+
+if __name__ == "__main__":
+    args = sys.argv[1:]
+    canvas = None
+    if len(args) >= 2 and args[0] == "--canvas":
+        canvas = args[1]
+        args = args[2:]
+    if len(args) != 4:
+        print(
+            f"USAGE: {sys.argv[0]} [--canvas NAME] path/to/CURRENT.qoi path/to/TARGET.png X Y",
+            file=sys.stderr,
+        )
+        exit(1)
+    run(args[0], args[1], int(args[2]), int(args[3]), canvas)
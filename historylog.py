@@ -0,0 +1,185 @@
+#!/bin/false
+# This is a library.
+
+from array import array
+from collections import namedtuple
+import os
+import struct
+
+# user_id, time, index, value
+RECORD_STRUCT = struct.Struct("<qdIB")
+# Writes that weren't done by any particular user, e.g. by /null.
+SYSTEM_USER_ID = 0
+READ_BLOCK_RECORDS = 4096
+
+HistoryRecord = namedtuple("HistoryRecord", ["user_id", "time", "index", "value"])
+
+
+class HistoryLog:
+    """
+    Append-only log of all writes, with fixed-size binary records.
+    Appending is cheap; sync() makes everything appended so far durable in one go, and returns how many bytes that was.
+    To keep appending while the fsync runs in another thread, split it up: flush(), then fsync(), then mark_synced().
+    With readonly=True, the log can be inspected while the bot is still appending to it.
+    """
+
+    def __init__(self, path, readonly=False):
+        self.path = path
+        self.readonly = readonly
+        self.fp = open(path, "rb" if readonly else "a+b")
+        size = os.fstat(self.fp.fileno()).st_size
+        torn_bytes = size % RECORD_STRUCT.size
+        if torn_bytes != 0 and not readonly:
+            # The process must have died while appending. The incomplete record never got acknowledged, so drop it.
+            print(f"Truncating {torn_bytes} bytes of a torn record from {path}")
+            self.fp.truncate(size - torn_bytes)
+            os.fsync(self.fp.fileno())
+        self.count = size // RECORD_STRUCT.size
+        self.unsynced = 0
+
+    @staticmethod
+    def create(path, records):
+        """Replaces the file at path with these (user_id, time, index, value) records. A crash leaves the old file."""
+        tmp_path = f"{path}.tmp"
+        with open(tmp_path, "wb") as fp:
+            for user_id, timestamp, index, value in records:
+                fp.write(RECORD_STRUCT.pack(user_id, timestamp, index, value))
+            fp.flush()
+            os.fsync(fp.fileno())
+        os.replace(tmp_path, path)
+
+    def refresh(self):
+        """Picks up records that another process appended in the meantime."""
+        assert self.readonly, self.path
+        self.count = os.fstat(self.fp.fileno()).st_size // RECORD_STRUCT.size
+
+    def append(self, user_id, timestamp, index, value):
+        assert not self.readonly, self.path
+        self.fp.write(RECORD_STRUCT.pack(user_id, timestamp, index, value))
+        self.count += 1
+        self.unsynced += 1
+
+    def sync(self):
+        num_records = self.flush()
+        if num_records != 0:
+            self.fsync()
+        return self.mark_synced(num_records)
+
+    def flush(self):
+        """Hands all appended records to the OS. Returns how many of them aren't durable yet. Same thread as append()."""
+        self.fp.flush()
+        return self.unsynced
+
+    def fsync(self):
+        """Makes everything flushed so far durable. Can run in another thread."""
+        os.fsync(self.fp.fileno())
+
+    def mark_synced(self, num_records):
+        """Takes the result of a flush() that fsync() has since made durable. Returns the number of bytes."""
+        self.unsynced -= num_records
+        return num_records * RECORD_STRUCT.size
+
+    def __len__(self):
+        return self.count
+
+    def __getitem__(self, i):
+        if i < 0:
+            i += self.count
+        if not (0 <= i < self.count):
+            raise IndexError(i)
+        self.fp.flush()
+        raw = os.pread(self.fp.fileno(), RECORD_STRUCT.size, i * RECORD_STRUCT.size)
+        return HistoryRecord(*RECORD_STRUCT.unpack(raw))
+
+    def read(self, start=0, stop=None):
+        """Yields the records in the range [start, stop), reading in large blocks."""
+        if stop is None or stop > self.count:
+            stop = self.count
+        self.fp.flush()
+        while start < stop:
+            num_records = min(stop - start, READ_BLOCK_RECORDS)
+            raw = os.pread(
+                self.fp.fileno(),
+                num_records * RECORD_STRUCT.size,
+                start * RECORD_STRUCT.size,
+            )
+            for record in RECORD_STRUCT.iter_unpack(raw):
+                yield HistoryRecord(*record)
+            start += num_records
+
+    def __iter__(self):
+        return self.read()
+
+
+class HistoryIndex:
+    """
+    Reverse indexes over a HistoryLog: For each offset, and for each user, the chain of their writes.
+
+    Each chain is stored as "most recent write" plus "previous write in the same chain" per record,
+    so the whole index only needs a few bytes per record, and appending stays O(1).
+    It starts out empty, and catch_up() indexes whatever got appended to the log since.
+    """
+
+    def __init__(self, history, buffer_length):
+        self.history = history
+        self.last_by_offset = array("i", [-1]) * buffer_length
+        self.prev_by_offset = array("i")
+        self.last_by_user = dict()
+        self.prev_by_user = array("i")
+
+    def __len__(self):
+        return len(self.prev_by_offset)
+
+    def catch_up(self, stop=None):
+        """Indexes all records up to stop (default: the end of the log) that aren't indexed yet."""
+        start = len(self.prev_by_offset)
+        for i, record in enumerate(self.history.read(start, stop), start):
+            self.add(i, record.user_id, record.index)
+
+    def add(self, history_index, user_id, offset):
+        assert history_index == len(self.prev_by_offset), history_index
+        self.prev_by_offset.append(self.last_by_offset[offset])
+        self.last_by_offset[offset] = history_index
+        self.prev_by_user.append(self.last_by_user.get(user_id, -1))
+        self.last_by_user[user_id] = history_index
+
+    def writes_at_offset(self, offset):
+        """Yields the history indices of all writes to this offset, most recent first."""
+        i = self.last_by_offset[offset]
+        while i >= 0:
+            yield i
+            i = self.prev_by_offset[i]
+
+    def writes_by_user(self, user_id):
+        """Yields the history indices of all writes by this user, most recent first."""
+        i = self.last_by_user.get(user_id, -1)
+        while i >= 0:
+            yield i
+            i = self.prev_by_user[i]
+
+    def revert_plan(self, user_id, since=0):
+        """
+        Determines how to undo all writes by the user at or after `since`.
+        Returns a dict offset -> value that each touched byte should be restored to.
+        Offsets where someone else wrote after the user are left alone.
+        """
+        offsets = set()
+        for i in self.writes_by_user(user_id):
+            record = self.history[i]
+            if record.time < since:
+                break
+            offsets.add(record.index)
+        plan = dict()
+        for offset in offsets:
+            writes = self.writes_at_offset(offset)
+            if self.history[next(writes)].user_id != user_id:
+                # Someone else already wrote there afterwards, maybe even fixed it.
+                continue
+            restore_value = 0
+            for i in writes:
+                record = self.history[i]
+                if record.user_id != user_id or record.time < since:
+                    restore_value = record.value
+                    break
+            plan[offset] = restore_value
+        return plan
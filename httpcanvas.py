@@ -0,0 +1,266 @@
+#!/bin/false
+# This is a library.
+
+from urllib.parse import parse_qs, urlsplit
+import asyncio
+import io
+import json
+import traceback
+
+import myqoi
+
+MAX_HEADER_BYTES = 16 * 1024
+# Slow clients must not be able to hold connections open forever.
+REQUEST_TIMEOUT_SECONDS = 10
+LONG_POLL_SECONDS = 25
+MAX_CHANGES_PER_RESPONSE = 100000
+STATUS_TEXTS = {
+    200: "OK",
+    206: "Partial Content",
+    304: "Not Modified",
+    400: "Bad Request",
+    404: "Not Found",
+    405: "Method Not Allowed",
+    408: "Request Timeout",
+    416: "Range Not Satisfiable",
+    500: "Internal Server Error",
+}
+
+
+class HttpError(Exception):
+    def __init__(self, status, message="", headers=None):
+        super().__init__(message)
+        self.status = status
+        self.headers = dict() if headers is None else headers
+
+
+def _parse_range(range_header, total_length):
+    # Only a single range is supported, which is all any sane client asks for.
+    unsatisfiable = HttpError(416, headers={"Content-Range": f"bytes */{total_length}"})
+    if not range_header.startswith("bytes=") or "," in range_header:
+        raise unsatisfiable
+    start_str, _, stop_str = range_header[len("bytes=") :].partition("-")
+    try:
+        if start_str == "":
+            # Suffix range, e.g. "bytes=-8"
+            start = max(0, total_length - int(stop_str))
+            stop = total_length
+        else:
+            start = int(start_str)
+            stop = int(stop_str) + 1 if stop_str else total_length
+    except ValueError:
+        raise unsatisfiable
+    stop = min(stop, total_length)
+    if not (0 <= start < stop):
+        raise unsatisfiable
+    return (start, stop)
+
+
+def _slice_parts(parts, start, stop):
+    # Like b"".join(parts)[start:stop], but without building the whole thing first.
+    result = []
+    for part in parts:
+        if start < len(part) and stop > 0:
+            result.append(bytes(part[max(0, start) : stop]))
+        start -= len(part)
+        stop -= len(part)
+    return b"".join(result)
+
+
+class CanvasServer:
+    """
+    Minimal read-only HTTP server for the canvases, running on the bot's event loop:
+    - /canvas.qoi: the raw QOI file, straight from the in-memory buffer, supports byte ranges
+    - /canvas.png: the rendered image, shared with /snapshot and the channel posts
+    - /indices: for each pixel, the data offset of the chunk that produced it, as little-endian int32
+    - /impact.png: for each data offset, how many pixels a write there could change, see myqoi.ImpactMap
+    - /changes?since=VERSION: all writes since that version, waits for new ones if there are none yet
+    - /metrics: the metrics_registry (if any), in the Prometheus text format
+    Every response carries the canvas version (number of writes so far) as its ETag.
+    These paths refer to the main canvas. For any other canvas, prefix them with its name, e.g. /practice/canvas.qoi.
+    """
+
+    def __init__(self, stores, main_name, metrics_registry=None):
+        # stores: dict from canvas name to Store
+        self.stores = stores
+        self.main_name = main_name
+        self.metrics_registry = metrics_registry
+        # All per canvas name:
+        self.indices_caches = dict()
+        # Concurrent requests for a new version share a single decode.
+        self.indices_locks = {name: asyncio.Lock() for name in stores}
+        # (version, ImpactMap, heatmap PNG), only built once somebody asks for it.
+        self.impact_caches = dict()
+        self.impact_locks = {name: asyncio.Lock() for name in stores}
+
+    async def start(self, host, port):
+        server = await asyncio.start_server(self.handle_connection, host, port)
+        print(f"Serving canvas on http://{host}:{port}/")
+        return server
+
+    async def handle_connection(self, reader, writer):
+        method = "GET"
+        try:
+            request_head = await asyncio.wait_for(
+                reader.readuntil(b"\r\n\r\n"), REQUEST_TIMEOUT_SECONDS
+            )
+            if len(request_head) > MAX_HEADER_BYTES:
+                raise HttpError(400)
+            lines = request_head.decode("latin-1").split("\r\n")
+            method, target, _version = lines[0].split(" ")
+            headers = dict()
+            for line in lines[1:]:
+                if ":" in line:
+                    name, _, value = line.partition(":")
+                    headers[name.strip().lower()] = value.strip()
+            if method not in ["GET", "HEAD"]:
+                raise HttpError(405)
+            status, response_headers, body = await self.dispatch(target, headers)
+        except HttpError as e:
+            status, response_headers, body = e.status, e.headers, str(e).encode()
+        except (asyncio.IncompleteReadError, asyncio.LimitOverrunError, ValueError):
+            status, response_headers, body = 400, dict(), b""
+        except asyncio.TimeoutError:
+            status, response_headers, body = 408, dict(), b""
+        except Exception as e:
+            print(f"Failed to handle HTTP request: {e!r}")
+            traceback.print_exc()
+            status, response_headers, body = 500, dict(), b""
+        response_headers["Content-Length"] = str(len(body))
+        response_headers["Connection"] = "close"
+        head = f"HTTP/1.1 {status} {STATUS_TEXTS[status]}\r\n"
+        head += "".join(
+            f"{name}: {value}\r\n" for name, value in response_headers.items()
+        )
+        writer.write(head.encode("latin-1") + b"\r\n")
+        if status != 304 and method != "HEAD":
+            writer.write(body)
+        try:
+            await asyncio.wait_for(writer.drain(), REQUEST_TIMEOUT_SECONDS)
+        except (asyncio.TimeoutError, ConnectionError):
+            pass
+        finally:
+            writer.close()
+
+    async def dispatch(self, target, headers):
+        url = urlsplit(target)
+        path = url.path
+        store = self.stores[self.main_name]
+        name, _, rest = path[1:].partition("/")
+        if rest and name in self.stores:
+            store = self.stores[name]
+            path = "/" + rest
+        if path == "/canvas.qoi":
+            version = store.get_num_bytes_written()
+            parts = [store.qoi_preamble, store.get_raw_data(), myqoi.QOI_END_MARKER]
+            return self.respond(headers, version, "image/qoi", parts)
+        if path == "/canvas.png":
+            frame = await store.get_frame()
+            return self.respond(headers, frame.version, "image/png", [frame.png_file])
+        if path == "/indices":
+            version, indices = await self.get_indices(store)
+            return self.respond(headers, version, "application/octet-stream", [indices])
+        if path == "/impact.png":
+            version, png_file = await self.get_impact_png(store)
+            return self.respond(headers, version, "image/png", [png_file])
+        if path == "/changes":
+            try:
+                since = int(parse_qs(url.query).get("since", ["0"])[0])
+            except ValueError:
+                raise HttpError(400, "since must be an integer")
+            return await self.changes(store, since)
+        if url.path == "/metrics" and self.metrics_registry is not None:
+            body = self.metrics_registry.expose().encode()
+            return (200, {"Content-Type": "text/plain; version=0.0.4"}, body)
+        raise HttpError(404)
+
+    def respond(self, headers, version, content_type, parts):
+        etag = f'"{version}"'
+        response_headers = {
+            "Content-Type": content_type,
+            "ETag": etag,
+            "Accept-Ranges": "bytes",
+        }
+        if headers.get("if-none-match") == etag:
+            return (304, response_headers, b"")
+        total_length = sum(len(part) for part in parts)
+        range_header = headers.get("range")
+        if range_header is None:
+            return (200, response_headers, _slice_parts(parts, 0, total_length))
+        start, stop = _parse_range(range_header, total_length)
+        response_headers["Content-Range"] = f"bytes {start}-{stop - 1}/{total_length}"
+        return (206, response_headers, _slice_parts(parts, start, stop))
+
+    async def get_indices(self, store):
+        async with self.indices_locks[store.name]:
+            return await self._get_indices(store)
+
+    async def _get_indices(self, store):
+        version = store.get_num_bytes_written()
+        cached_version, _ = self.indices_caches.get(store.name, (None, None))
+        if cached_version != version:
+            snapshot = bytes(store.get_raw_data())
+            result = await asyncio.get_running_loop().run_in_executor(
+                None,
+                lambda: myqoi.decode_all(
+                    snapshot,
+                    store.width,
+                    store.height,
+                    want_pixels=False,
+                    want_chunk_starts=False,
+                ),
+            )
+            self.indices_caches[store.name] = (version, result.indices.tobytes())
+        return self.indices_caches[store.name]
+
+    async def get_impact_png(self, store):
+        # The ImpactMap gets updated in place, so only one request may do that at a time.
+        async with self.impact_locks[store.name]:
+            return await self._get_impact_png(store)
+
+    async def _get_impact_png(self, store):
+        version = store.get_num_bytes_written()
+        cached_version, impact_map, _ = self.impact_caches.get(
+            store.name, (None, None, None)
+        )
+        if cached_version != version:
+            snapshot = bytearray(store.get_raw_data())
+
+            def compute():
+                nonlocal impact_map
+                if impact_map is None:
+                    impact_map = myqoi.ImpactMap(snapshot, store.width, store.height)
+                else:
+                    changed = {
+                        record.index
+                        for record in store.history.read(cached_version, version)
+                    }
+                    impact_map.update(changed, snapshot)
+                buffer = io.BytesIO()
+                impact_map.heatmap().save(buffer, "png")
+                return buffer.getvalue()
+
+            try:
+                png_file = await asyncio.get_running_loop().run_in_executor(
+                    None, compute
+                )
+            except BaseException:
+                # The map might be half-updated, so start from scratch next time.
+                self.impact_caches.pop(store.name, None)
+                raise
+            self.impact_caches[store.name] = (version, impact_map, png_file)
+        return (version, self.impact_caches[store.name][2])
+
+    async def changes(self, store, since):
+        if since < 0:
+            raise HttpError(400, "since must not be negative")
+        if since >= store.get_num_bytes_written():
+            await store.wait_for_change(LONG_POLL_SECONDS)
+        version = store.get_num_bytes_written()
+        stop = min(version, since + MAX_CHANGES_PER_RESPONSE)
+        writes = [
+            [record.index, record.value] for record in store.history.read(since, stop)
+        ]
+        # If there were more changes than fit into one response, the client simply asks again from "version".
+        body = json.dumps(dict(version=stop, writes=writes)).encode()
+        return (200, {"Content-Type": "application/json", "ETag": f'"{stop}"'}, body)
@@ -0,0 +1,96 @@
+#!/bin/false
+# This is a library.
+
+import asyncio
+import time
+
+# How long to wait before trying again when a group commit fails.
+COMMIT_RETRY_SECONDS = 1.0
+
+
+class QueueFull(Exception):
+    pass
+
+
+class WriteQueue:
+    """
+    Bounded queue of writes, which are applied in micro-batches by a single consumer task.
+
+    `apply` is called for each write, in order, and its return value is handed back to whoever submitted it.
+    Once a batch is applied, `make_durable` is awaited for the whole batch ("group commit").
+    Only then do the submitters get their results. The batch can't be taken back once it's applied,
+    so if `make_durable` fails, it is retried until it succeeds, and the submitters keep waiting.
+    Meanwhile, new writes pile up in the queue until it's full, and get rejected from there on.
+    """
+
+    def __init__(self, apply, make_durable, max_queued, max_batch, window_seconds):
+        self.apply = apply
+        self.make_durable = make_durable
+        self.max_batch = max_batch
+        self.window_seconds = window_seconds
+        self.queue = asyncio.Queue(maxsize=max_queued)
+        # Backpressure metrics:
+        self.num_submitted = 0
+        self.num_rejected = 0
+        self.num_batches = 0
+        self.num_commit_failures = 0
+        self.max_depth = 0
+        self.last_batch_size = 0
+        self.last_batch_seconds = 0.0
+
+    async def submit(self, write):
+        future = asyncio.get_running_loop().create_future()
+        try:
+            self.queue.put_nowait((write, future))
+        except asyncio.QueueFull:
+            self.num_rejected += 1
+            raise QueueFull()
+        self.num_submitted += 1
+        self.max_depth = max(self.max_depth, self.queue.qsize())
+        return await future
+
+    async def _collect_batch(self):
+        batch = [await self.queue.get()]
+        # Give other writes a short window to join this batch, so that they share a single commit.
+        deadline = time.monotonic() + self.window_seconds
+        while len(batch) < self.max_batch:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            try:
+                batch.append(await asyncio.wait_for(self.queue.get(), remaining))
+            except asyncio.TimeoutError:
+                break
+        return batch
+
+    async def run(self):
+        while True:
+            batch = await self._collect_batch()
+            start = time.monotonic()
+            results = []
+            for write, future in batch:
+                try:
+                    results.append((future, self.apply(*write), None))
+                except Exception as e:
+                    results.append((future, None, e))
+            while True:
+                try:
+                    await self.make_durable()
+                    break
+                except Exception as e:
+                    self.num_commit_failures += 1
+                    print(f"Group commit failed, retrying: {e}")
+                    await asyncio.sleep(COMMIT_RETRY_SECONDS)
+            for future, result, exception in results:
+                if future.cancelled():
+                    continue
+                if exception is not None:
+                    future.set_exception(exception)
+                else:
+                    future.set_result(result)
+            self.num_batches += 1
+            self.last_batch_size = len(batch)
+            self.last_batch_seconds = time.monotonic() - start
+
+    def str_stats(self):
+        return f"queue depth {self.queue.qsize()} (max {self.max_depth}), {self.num_submitted} submitted, {self.num_rejected} rejected, {self.num_batches} batches ({self.num_commit_failures} failed commits), last batch {self.last_batch_size} writes in {self.last_batch_seconds * 1000:.1f} ms"
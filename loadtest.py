@@ -0,0 +1,203 @@
+#!/usr/bin/env python3
+
+import asyncio
+import os
+import random
+import sys
+import tempfile
+import time
+import types
+
+try:
+    import mysecrets
+except ImportError:
+    # The load test never talks to Telegram, so any values will do.
+    mysecrets = types.ModuleType("mysecrets")
+    mysecrets.TOKEN = "1111111111:AAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAA"
+    mysecrets.OWNER_ID = 123456789
+    mysecrets.CHANNEL_ID = -1001234567890
+    sys.modules["mysecrets"] = mysecrets
+
+DEFAULT_NUM_USERS = 5000
+DEFAULT_MESSAGES_PER_SECOND = 200
+DEFAULT_DURATION_SECONDS = 30
+# Much more often than in production, so that a short run still sees a few renders.
+SWALLOW_INTERVAL_SECONDS = 5
+# Fraction of messages that are garbage, or admin commands. Everything else is a well-formed write.
+# Rate limit violations happen naturally, whenever a user is picked again within the timeout.
+INVALID_FRACTION = 0.05
+ADMIN_FRACTION = 0.001
+
+
+class FakeMessage:
+    def __init__(self, text, replies):
+        self.text = text
+        self.replies = replies
+
+    async def reply_text(self, text):
+        self.replies.append(text)
+
+    async def reply_media_group(self, media, caption):
+        self.replies.append(caption)
+
+
+class FakeBot:
+    def __init__(self):
+        self.num_posts = 0
+
+    async def send_media_group(self, **_kwargs):
+        self.num_posts += 1
+
+
+def make_update(user_id, text, replies):
+    user = types.SimpleNamespace(id=user_id, first_name=f"user{user_id}")
+    return types.SimpleNamespace(
+        message=FakeMessage(text, replies), effective_user=user
+    )
+
+
+def classify(reply):
+    if reply.startswith("Done, "):
+        return "accepted"
+    if reply.startswith("Sorry, you should have waited"):
+        return "rate_limited"
+    if reply.startswith("Sorry, I'm a bit overwhelmed"):
+        return "overwhelmed"
+    return "invalid"
+
+
+def percentiles(samples):
+    if not samples:
+        return "no samples"
+    samples = sorted(samples)
+    p50 = samples[len(samples) // 2]
+    p99 = samples[min(len(samples) - 1, len(samples) * 99 // 100)]
+    return f"p50 {p50 * 1000:8.2f} ms, p99 {p99 * 1000:8.2f} ms, max {samples[-1] * 1000:8.2f} ms ({len(samples)} samples)"
+
+
+def timed(samples, fn):
+    def wrapper(*args):
+        start = time.perf_counter()
+        try:
+            return fn(*args)
+        finally:
+            samples.append(time.perf_counter() - start)
+
+    return wrapper
+
+
+class LoadTest:
+    def __init__(self, bot, num_users, messages_per_second, duration_seconds):
+        self.bot = bot
+        self.num_users = num_users
+        self.messages_per_second = messages_per_second
+        self.duration_seconds = duration_seconds
+        self.rng = random.Random(42)
+        self.store = bot.CanvasRegistry.get_singleton().main()
+        self.fake_bot = FakeBot()
+        self.latencies = dict()
+        self.outcomes = dict()
+        self.commit_seconds = []
+        self.group_commit_seconds = []
+        self.render_seconds = []
+        self.store.write_frozen = timed(self.commit_seconds, self.store.write_frozen)
+        self.store.history.fsync = timed(
+            self.group_commit_seconds, self.store.history.fsync
+        )
+        self.store.render_frame = timed(self.render_seconds, self.store.render_frame)
+
+    def next_message(self):
+        user_id = self.rng.randrange(1, self.num_users + 1)
+        roll = self.rng.random()
+        if roll < ADMIN_FRACTION:
+            command = self.rng.choice(["stats", "blame", "null"])
+            offset = self.rng.randrange(self.store.buffer_length)
+            return (command, mysecrets.OWNER_ID, f"/{command} {offset}")
+        if roll < ADMIN_FRACTION + INVALID_FRACTION:
+            return ("set_byte", user_id, "hello")
+        offset = self.rng.randrange(self.store.buffer_length)
+        return ("set_byte", user_id, f"{offset} {self.rng.randrange(256)}")
+
+    async def handle(self, handler_name, user_id, text):
+        replies = []
+        update = make_update(user_id, text, replies)
+        start = time.perf_counter()
+        await getattr(self.bot, handler_name)(update, None)
+        self.latencies.setdefault(handler_name, []).append(time.perf_counter() - start)
+        if handler_name == "set_byte":
+            for reply in replies:
+                outcome = classify(reply)
+                self.outcomes[outcome] = self.outcomes.get(outcome, 0) + 1
+
+    async def swallow_periodically(self):
+        context = types.SimpleNamespace(
+            job=types.SimpleNamespace(data=self.store), bot=self.fake_bot
+        )
+        while True:
+            await asyncio.sleep(SWALLOW_INTERVAL_SECONDS)
+            await self.bot.swallow_store(context)
+
+    async def run(self):
+        consumer = asyncio.create_task(self.store.write_queue.run())
+        swallower = asyncio.create_task(self.swallow_periodically())
+        loop = asyncio.get_running_loop()
+        tasks = set()
+        start = loop.time()
+        next_arrival = start
+        while next_arrival < start + self.duration_seconds:
+            # Poisson arrivals, like many independent users would produce.
+            next_arrival += self.rng.expovariate(self.messages_per_second)
+            await asyncio.sleep(max(0, next_arrival - loop.time()))
+            task = asyncio.create_task(self.handle(*self.next_message()))
+            tasks.add(task)
+            task.add_done_callback(tasks.discard)
+        await asyncio.gather(*tasks)
+        swallower.cancel()
+        await self.bot.swallow_store(
+            types.SimpleNamespace(
+                job=types.SimpleNamespace(data=self.store), bot=self.fake_bot
+            )
+        )
+        consumer.cancel()
+
+    def report(self):
+        print(f"Final state: {self.store.str_stats()}")
+        print(f"Outcomes of set_byte: {self.outcomes}")
+        for handler_name, samples in sorted(self.latencies.items()):
+            print(f"{handler_name:>20} latency: {percentiles(samples)}")
+        print(f"{'group commit':>20}  (sync): {percentiles(self.group_commit_seconds)}")
+        print(f"{'commit':>20}  (full): {percentiles(self.commit_seconds)}")
+        print(f"{'render':>20}        : {percentiles(self.render_seconds)}")
+        print(f"Posted {self.fake_bot.num_posts} frames to the fake channel")
+
+
+def run(num_users, messages_per_second, duration_seconds):
+    script_dir = os.path.dirname(os.path.abspath(__file__))
+    with tempfile.TemporaryDirectory() as workdir:
+        # The store always uses relative paths, so this keeps the real state untouched.
+        os.chdir(workdir)
+        sys.path.insert(0, script_dir)
+        import bot
+
+        print(
+            f"Simulating {num_users} users, {messages_per_second} messages/s, for {duration_seconds} s, in {workdir}"
+        )
+        load_test = LoadTest(bot, num_users, messages_per_second, duration_seconds)
+        asyncio.run(load_test.run())
+        load_test.report()
+        os.chdir(script_dir)
+
+
+if __name__ == "__main__":
+    if len(sys.argv) > 4 or any(arg.startswith("-") for arg in sys.argv[1:]):
+        print(
+            f"USAGE: {sys.argv[0]} [NUM_USERS [MESSAGES_PER_SECOND [DURATION_SECONDS]]]",
+            file=sys.stderr,
+        )
+        exit(1)
+    args = sys.argv[1:] + [None] * (3 - len(sys.argv[1:]))
+    run(
+        int(args[0] or DEFAULT_NUM_USERS),
+        float(args[1] or DEFAULT_MESSAGES_PER_SECOND),
+        float(args[2] or DEFAULT_DURATION_SECONDS),
+    )
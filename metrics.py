@@ -0,0 +1,202 @@
+#!/bin/false
+# This is a library.
+
+from bisect import bisect_left
+import asyncio
+import cProfile
+import threading
+import time
+
+# In seconds. Covers everything from a single handler call to a full decode of a pathological canvas.
+DEFAULT_BUCKETS = (
+    0.0005,
+    0.001,
+    0.0025,
+    0.005,
+    0.01,
+    0.025,
+    0.05,
+    0.1,
+    0.25,
+    0.5,
+    1,
+    2.5,
+    5,
+    10,
+)
+
+
+def _format_labels(label_names, label_values, extra=""):
+    parts = [f'{name}="{value}"' for name, value in zip(label_names, label_values)]
+    if extra:
+        parts.append(extra)
+    return "{" + ",".join(parts) + "}" if parts else ""
+
+
+class Counter:
+    def __init__(self, name, documentation, label_names=()):
+        self.name = name
+        self.documentation = documentation
+        self.label_names = tuple(label_names)
+        self.lock = threading.Lock()
+        self.values = dict()
+
+    def inc(self, amount=1, **labels):
+        key = tuple(labels[name] for name in self.label_names)
+        with self.lock:
+            self.values[key] = self.values.get(key, 0) + amount
+
+    def expose(self):
+        lines = [
+            f"# HELP {self.name} {self.documentation}",
+            f"# TYPE {self.name} counter",
+        ]
+        with self.lock:
+            for key, value in sorted(self.values.items()):
+                lines.append(
+                    f"{self.name}{_format_labels(self.label_names, key)} {value}"
+                )
+        return lines
+
+    def summary(self):
+        with self.lock:
+            return {
+                "/".join(map(str, (self.name,) + key)): value
+                for key, value in self.values.items()
+            }
+
+
+class Gauge:
+    """A value that is only computed when someone looks at it."""
+
+    def __init__(self, name, documentation, fn):
+        self.name = name
+        self.documentation = documentation
+        self.fn = fn
+
+    def expose(self):
+        return [
+            f"# HELP {self.name} {self.documentation}",
+            f"# TYPE {self.name} gauge",
+            f"{self.name} {self.fn()}",
+        ]
+
+    def summary(self):
+        return {self.name: self.fn()}
+
+
+class Histogram:
+    def __init__(self, name, documentation, label_names=(), buckets=DEFAULT_BUCKETS):
+        self.name = name
+        self.documentation = documentation
+        self.label_names = tuple(label_names)
+        self.buckets = tuple(buckets)
+        self.lock = threading.Lock()
+        # Per label values: [count per bucket (the last one is +Inf), sum]
+        self.values = dict()
+
+    def observe(self, value, **labels):
+        key = tuple(labels[name] for name in self.label_names)
+        bucket = bisect_left(self.buckets, value)
+        with self.lock:
+            entry = self.values.get(key)
+            if entry is None:
+                entry = [[0] * (len(self.buckets) + 1), 0.0]
+                self.values[key] = entry
+            entry[0][bucket] += 1
+            entry[1] += value
+
+    def time(self, **labels):
+        return _Timer(self, labels)
+
+    def expose(self):
+        lines = [
+            f"# HELP {self.name} {self.documentation}",
+            f"# TYPE {self.name} histogram",
+        ]
+        with self.lock:
+            for key, (counts, total) in sorted(self.values.items()):
+                cumulative = 0
+                for bound, count in zip(self.buckets + ("+Inf",), counts):
+                    cumulative += count
+                    labels = _format_labels(self.label_names, key, f'le="{bound}"')
+                    lines.append(f"{self.name}_bucket{labels} {cumulative}")
+                labels = _format_labels(self.label_names, key)
+                lines.append(f"{self.name}_sum{labels} {total}")
+                lines.append(f"{self.name}_count{labels} {cumulative}")
+        return lines
+
+    def summary(self):
+        # Mean duration in milliseconds, which is good enough for a log line.
+        summary = dict()
+        with self.lock:
+            for key, (counts, total) in self.values.items():
+                name = "/".join(map(str, (self.name,) + key))
+                summary[name] = f"{total / sum(counts) * 1000:.1f}ms_x{sum(counts)}"
+        return summary
+
+
+class _Timer:
+    def __init__(self, histogram, labels):
+        self.histogram = histogram
+        self.labels = labels
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *_exc_info):
+        self.histogram.observe(time.perf_counter() - self.start, **self.labels)
+
+
+class Registry:
+    """
+    Collection of metrics, which can be exported in the Prometheus text format, or as a single log line.
+    All metrics may be updated from any thread.
+    """
+
+    def __init__(self):
+        self.metrics = []
+
+    def counter(self, name, documentation, label_names=()):
+        return self._register(Counter(name, documentation, label_names))
+
+    def gauge(self, name, documentation, fn):
+        return self._register(Gauge(name, documentation, fn))
+
+    def histogram(self, name, documentation, label_names=(), buckets=DEFAULT_BUCKETS):
+        return self._register(Histogram(name, documentation, label_names, buckets))
+
+    def _register(self, metric):
+        self.metrics.append(metric)
+        return metric
+
+    def expose(self):
+        lines = []
+        for metric in self.metrics:
+            lines.extend(metric.expose())
+        return "\n".join(lines) + "\n"
+
+    def summary_line(self):
+        summary = dict()
+        for metric in self.metrics:
+            summary.update(metric.summary())
+        return " ".join(f"{key}={value}" for key, value in summary.items())
+
+
+async def monitor_loop_lag(histogram, interval_seconds=1.0):
+    """Measures how late the event loop wakes up a sleeping task, i.e. how long it was busy with other work."""
+    loop = asyncio.get_running_loop()
+    while True:
+        start = loop.time()
+        await asyncio.sleep(interval_seconds)
+        histogram.observe(max(0.0, loop.time() - start - interval_seconds))
+
+
+def profile_call(path, fn, *args):
+    """Calls fn(*args), and dumps a cProfile of that call to the given path, for use with pstats or snakeviz."""
+    profiler = cProfile.Profile()
+    try:
+        return profiler.runcall(fn, *args)
+    finally:
+        profiler.dump_stats(path)
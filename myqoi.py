@@ -1,9 +1,17 @@
 #!/bin/false
 # This is a library.
 
+from array import array
+from collections import namedtuple
+from concurrent.futures import ProcessPoolExecutor
 from enum import Enum
 from PIL import Image
 from typing import Tuple
+import bisect
+import heapq
+import math
+import os
+import struct
 import sys
 
 
@@ -17,12 +25,56 @@ class ChunkType(Enum):
     NONE = 7
 
 
+DecodeResult = namedtuple(
+    "DecodeResult", ["pixels", "indices", "chunk_starts", "overlay"]
+)
+Chunk = namedtuple(
+    "Chunk",
+    ["chunk_type", "rgba", "data_offset", "length", "px_start", "px_count"],
+)
+QoiHeader = namedtuple("QoiHeader", ["width", "height", "channels", "colorspace"])
+Segment = namedtuple(
+    "Segment",
+    [
+        "start",
+        "stop",
+        "num_pixels",
+        "pixels",
+        "checkpoints",
+        "live_slots",
+        "live_last",
+        "last_written",
+        "table",
+        "last",
+        "truncated",
+    ],
+)
+
+
 VERBOSE = False
 COL_QOI_OP_RGB = (255, 0, 0)
 COL_QOI_OP_RGBA = (255, 0, 128)
 COL_QOI_OP_INDEX = (0, 255, 0)
 COL_QOI_OP_DIFF = (0, 255, 255)
 COL_QOI_OP_LUMA = (255, 128, 0)
+COL_QOI_OP_RUN = (0, 0, 255)
+COL_PADDING = (128, 0, 128)
+# Distance (in data bytes) between two checkpoints of the IncrementalDecoder.
+CHECKPOINT_INTERVAL = 1024
+# How far before its segment a speculative decode starts, to guess the chunk alignment and decoder state there.
+PARALLEL_WARMUP_BYTES = 4096
+# Distance (in data bytes) between two checkpoints of a speculatively decoded segment.
+PARALLEL_CHECKPOINT_INTERVAL = 4096
+# Smaller segments aren't worth shipping to another process.
+PARALLEL_MIN_SEGMENT_BYTES = 65536
+QOI_MAGIC = b"qoif"
+QOI_HEADER_STRUCT = struct.Struct(">4sIIBB")
+QOI_END_MARKER = bytes([0, 0, 0, 0, 0, 0, 0, 1])
+
+
+def _hash_rgba(rgba):
+    r, g, b, a = rgba
+    return (r * 3 + g * 5 + b * 7 + a * 11) % 64
 
 
 class QoiEater:
@@ -42,6 +94,13 @@ class QoiEater:
         index_position = (r * 3 + g * 5 + b * 7 + a * 11) % 64
         self.table[index_position] = rgba
 
+    def get_state(self):
+        return (self.data_offset, self.px_offset, tuple(self.table), self.last)
+
+    def set_state(self, state):
+        self.data_offset, self.px_offset, table, self.last = state
+        self.table = list(table)
+
     def consumebyte(self):
         if self.data_offset >= len(self.qoidata):
             return 0
@@ -124,7 +183,7 @@ def decode(qoidata, w, h):
             print(f"Expect {qoi_eater.w * qoi_eater.h} pixels, got {len(data)} instead")
             print(f"Padding with {missing} purple pixels?!?!")
         if missing > 0:
-            data.extend([(128, 0, 128)] * missing)
+            data.extend([COL_PADDING] * missing)
         else:
             data = data[: qoi_eater.w * qoi_eater.h]
     assert len(data) == qoi_eater.w * qoi_eater.h, (len(data), qoi_eater.w, qoi_eater.h)
@@ -132,6 +191,547 @@ def decode(qoidata, w, h):
     return img
 
 
+class ChunkStream:
+    """
+    Lazily iterates over the chunks of the data, yielding one Chunk at a time.
+
+    Stops at the end of the data, at the same pixel limit as decode(), or as soon as max_pixels pixels or
+    max_bytes data bytes have been consumed, whichever comes first.
+    get_state() can be called at any time, and its result can be passed as `state` to resume from there later.
+    """
+
+    def __init__(self, qoidata, w, h, state=None, max_pixels=None, max_bytes=None):
+        self.qoi_eater = QoiEater(w, h, qoidata)
+        if state is not None:
+            self.qoi_eater.set_state(state)
+        self.hard_px_limit = 3 * w * h
+        self.px_limit = self.hard_px_limit
+        if max_pixels is not None:
+            self.px_limit = min(self.px_limit, max_pixels)
+        self.max_bytes = max_bytes
+        self.done = False
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        qoi_eater = self.qoi_eater
+        if self.done or qoi_eater.px_offset >= self.px_limit:
+            raise StopIteration
+        if self.max_bytes is not None and qoi_eater.data_offset >= self.max_bytes:
+            raise StopIteration
+        state = qoi_eater.get_state()
+        chunk_type, rgba = qoi_eater.consume()
+        if chunk_type == ChunkType.NONE or qoi_eater.px_offset > self.hard_px_limit:
+            # Same limit as in decode(), this chunk doesn't count anymore.
+            qoi_eater.set_state(state)
+            self.done = True
+            raise StopIteration
+        return Chunk(
+            chunk_type,
+            rgba,
+            state[0],
+            qoi_eater.data_offset - state[0],
+            state[1],
+            qoi_eater.px_offset - state[1],
+        )
+
+    def get_state(self):
+        return self.qoi_eater.get_state()
+
+
+def chunk_at_pixel(qoidata, w, h, x, y, state=None):
+    """Returns the Chunk that produces pixel (x, y), or None. Only decodes up to that pixel."""
+    px = x + w * y
+    for chunk in ChunkStream(qoidata, w, h, state=state, max_pixels=px + 1):
+        if chunk.px_start <= px < chunk.px_start + chunk.px_count:
+            return chunk
+    return None
+
+
+def _build_opcode_table():
+    # For each possible first byte of a chunk: The chunk type, and whatever can be precomputed from that byte.
+    opcode_table = []
+    for nextbyte in range(256):
+        if nextbyte == 0xFE:
+            opcode_table.append((ChunkType.QOI_OP_RGB, None))
+        elif nextbyte == 0xFF:
+            opcode_table.append((ChunkType.QOI_OP_RGBA, None))
+        elif (nextbyte & 0xC0) == 0x00:
+            opcode_table.append((ChunkType.QOI_OP_INDEX, nextbyte & 0x3F))
+        elif (nextbyte & 0xC0) == 0x40:
+            diff = (
+                ((nextbyte >> 4) & 0b11) - 2,
+                ((nextbyte >> 2) & 0b11) - 2,
+                ((nextbyte >> 0) & 0b11) - 2,
+            )
+            opcode_table.append((ChunkType.QOI_OP_DIFF, diff))
+        elif (nextbyte & 0xC0) == 0x80:
+            opcode_table.append((ChunkType.QOI_OP_LUMA, (nextbyte & 0x3F) - 32))
+        else:
+            opcode_table.append((ChunkType.QOI_OP_RUN, (nextbyte & 0x3F) + 1))
+    return opcode_table
+
+
+OPCODE_TABLE = _build_opcode_table()
+# For each possible first byte of a chunk: Whether its color builds on "last".
+BUILDS_ON_LAST = bytes(
+    kind in (ChunkType.QOI_OP_DIFF, ChunkType.QOI_OP_LUMA, ChunkType.QOI_OP_RUN)
+    for kind, _ in OPCODE_TABLE
+)
+
+
+def _read_padded(qoidata, offset, length):
+    # Reading past the end of the data yields zeros, just like QoiEater.consumebyte().
+    chunk = bytes(qoidata[offset : offset + length])
+    return chunk + bytes(length - len(chunk))
+
+
+def _build_overlay_colors():
+    return {
+        ChunkType.QOI_OP_RGB: bytes(COL_QOI_OP_RGB),
+        ChunkType.QOI_OP_RGBA: bytes(COL_QOI_OP_RGBA),
+        ChunkType.QOI_OP_INDEX: bytes(COL_QOI_OP_INDEX),
+        ChunkType.QOI_OP_DIFF: bytes(COL_QOI_OP_DIFF),
+        ChunkType.QOI_OP_LUMA: bytes(COL_QOI_OP_LUMA),
+        ChunkType.QOI_OP_RUN: bytes(COL_QOI_OP_RUN),
+    }
+
+
+OVERLAY_COLORS = _build_overlay_colors()
+
+
+def decode_all(
+    qoidata,
+    w,
+    h,
+    want_pixels=True,
+    want_indices=True,
+    want_chunk_starts=True,
+    want_overlay=False,
+):
+    """
+    Decodes everything in a single pass, but only builds the outputs that are asked for:
+    - pixels: Raw RGB bytes, same content as decode()
+    - indices: array('i') of the data offset of the chunk that produced each pixel, same content as decode_to_indices()
+    - chunk_starts: array('i') of the data offsets of all decoded chunks
+    - overlay: Raw RGB bytes, each pixel colored by the type of the chunk that produced it (see OVERLAY_COLORS)
+    Anything that wasn't asked for is None.
+    Writes directly into preallocated buffers, and fills runs with a single slice assignment.
+    """
+    w_h = w * h
+    px_limit = 3 * w_h
+    pixels = bytearray(w_h * 3) if want_pixels else None
+    indices = array("i", bytes(4 * w_h)) if want_indices else None
+    chunk_starts = array("i") if want_chunk_starts else None
+    overlay = bytearray(w_h * 3) if want_overlay else None
+    overlay_colors = OVERLAY_COLORS
+    opcode_table = OPCODE_TABLE
+    op_rgb = ChunkType.QOI_OP_RGB
+    op_rgba = ChunkType.QOI_OP_RGBA
+    op_index = ChunkType.QOI_OP_INDEX
+    op_diff = ChunkType.QOI_OP_DIFF
+    op_luma = ChunkType.QOI_OP_LUMA
+    op_run = ChunkType.QOI_OP_RUN
+    table = [(0, 0, 0, 0)] * 64
+    r, g, b, a = 0, 0, 0, 255
+    data_len = len(qoidata)
+    data_offset = 0
+    px_offset = 0
+    # Pixels beyond w*h are invisible, so only keep going if the caller wants to know about all chunks.
+    px_stop = px_limit if want_chunk_starts else w_h
+    while data_offset < data_len and px_offset < px_stop:
+        chunk_start = data_offset
+        kind, arg = opcode_table[qoidata[data_offset]]
+        data_offset += 1
+        run_length = 1
+        if kind is op_index:
+            r, g, b, a = table[arg]
+        elif kind is op_diff:
+            r = (r + arg[0]) % 256
+            g = (g + arg[1]) % 256
+            b = (b + arg[2]) % 256
+        elif kind is op_luma:
+            if data_offset < data_len:
+                xy = qoidata[data_offset]
+            else:
+                xy = 0
+            data_offset += 1
+            r = (r + ((xy >> 4) & 0x0F) - 8 + arg) % 256
+            g = (g + arg) % 256
+            b = (b + (xy & 0x0F) - 8 + arg) % 256
+        elif kind is op_rgb:
+            if data_offset + 3 <= data_len:
+                r = qoidata[data_offset]
+                g = qoidata[data_offset + 1]
+                b = qoidata[data_offset + 2]
+            else:
+                r, g, b = _read_padded(qoidata, data_offset, 3)
+            data_offset += 3
+        elif kind is op_rgba:
+            if data_offset + 4 <= data_len:
+                r = qoidata[data_offset]
+                g = qoidata[data_offset + 1]
+                b = qoidata[data_offset + 2]
+                a = qoidata[data_offset + 3]
+            else:
+                r, g, b, a = _read_padded(qoidata, data_offset, 4)
+            data_offset += 4
+        else:
+            run_length = arg
+        if kind is not op_run:
+            # Runs don't touch the table, not even a run of one pixel: The initial "last" isn't in the table.
+            table[(r * 3 + g * 5 + b * 7 + a * 11) % 64] = (r, g, b, a)
+        # Same limit as in decode():
+        if px_offset + run_length > px_limit:
+            break
+        if chunk_starts is not None:
+            chunk_starts.append(chunk_start)
+        if px_offset < w_h:
+            if run_length == 1:
+                if pixels is not None:
+                    i = px_offset * 3
+                    pixels[i] = r
+                    pixels[i + 1] = g
+                    pixels[i + 2] = b
+                if indices is not None:
+                    indices[px_offset] = chunk_start
+                if overlay is not None:
+                    overlay[px_offset * 3 : px_offset * 3 + 3] = overlay_colors[kind]
+            else:
+                px_end = min(px_offset + run_length, w_h)
+                if pixels is not None:
+                    pixels[px_offset * 3 : px_end * 3] = bytes((r, g, b)) * (
+                        px_end - px_offset
+                    )
+                if indices is not None:
+                    indices[px_offset:px_end] = array("i", [chunk_start]) * (
+                        px_end - px_offset
+                    )
+                if overlay is not None:
+                    overlay[px_offset * 3 : px_end * 3] = overlay_colors[kind] * (
+                        px_end - px_offset
+                    )
+        px_offset += run_length
+    if px_offset < w_h:
+        if VERBOSE:
+            print(f"Expect {w_h} pixels, got {px_offset} instead")
+            print(f"Padding with {w_h - px_offset} purple pixels / invalid indices?!?!")
+        if pixels is not None:
+            pixels[px_offset * 3 :] = bytes(COL_PADDING) * (w_h - px_offset)
+        if indices is not None:
+            indices[px_offset:] = array("i", [-1]) * (w_h - px_offset)
+        if overlay is not None:
+            overlay[px_offset * 3 :] = bytes(COL_PADDING) * (w_h - px_offset)
+    return DecodeResult(pixels, indices, chunk_starts, overlay)
+
+
+def decode_pixels(qoidata, w, h):
+    return decode_all(qoidata, w, h, want_indices=False, want_chunk_starts=False).pixels
+
+
+def decode_fast(qoidata, w, h):
+    return Image.frombuffer(
+        "RGB", (w, h), decode_pixels(qoidata, w, h), "raw", "RGB", 0, 1
+    )
+
+
+def _decode_segment(
+    qoidata,
+    w,
+    h,
+    segment_start,
+    segment_stop,
+    state=None,
+    px_base=0,
+    speculative=None,
+):
+    """
+    Decodes all chunks that start in [segment_start, segment_stop), with pixel positions relative to the segment.
+
+    Without a state (table, last), this is a speculative decode: It starts from scratch PARALLEL_WARMUP_BYTES
+    earlier, and by the time it reaches segment_start, it's usually aligned to the same chunk boundaries, and has
+    seen the same recent colors. It records checkpoints, and for each checkpoint what the rest of the segment
+    depends on: The table entries that get read before being overwritten, and whether the first chunk reads "last".
+
+    With the exact state and px_base, and such a speculative decode of the same segment, this decodes only until it
+    hits a checkpoint where all of that agrees, and takes the rest from the speculative decode.
+    """
+    w_h = w * h
+    px_limit = 3 * w_h
+    max_pixels = max(0, w_h - px_base)
+    pixels = bytearray(3 * max_pixels)
+    opcode_table = OPCODE_TABLE
+    op_rgba = ChunkType.QOI_OP_RGBA
+    op_index = ChunkType.QOI_OP_INDEX
+    op_diff = ChunkType.QOI_OP_DIFF
+    op_luma = ChunkType.QOI_OP_LUMA
+    op_run = ChunkType.QOI_OP_RUN
+    if state is None:
+        data_offset = max(0, segment_start - PARALLEL_WARMUP_BYTES)
+        table = [(0, 0, 0, 0)] * 64
+        if data_offset > 0:
+            # Hardly any image changes alpha. The unknown entries had better be opaque, too, otherwise a single
+            # QOI_OP_INDEX would spread alpha 0 to all following QOI_OP_RGB chunks, and never catch up.
+            table = [(0, 0, 0, 255)] * 64
+        r, g, b, a = 0, 0, 0, 255
+    else:
+        data_offset = segment_start
+        table = list(state[0])
+        r, g, b, a = state[1]
+    data_len = len(qoidata)
+    recording = False
+    start = data_offset
+    px_offset = 0
+    truncated = False
+    # Only for speculative decodes:
+    tracking = False
+    checkpoints = []
+    live_slots = []
+    live_last = []
+    last_written = [-1] * 64
+    untouched_since = [0] * 64
+    current = -1
+    # Only when resuming a speculative decode:
+    spec_offsets = (
+        [checkpoint[0] for checkpoint in speculative.checkpoints]
+        if speculative is not None
+        else []
+    )
+    spec_index = 0
+    # Offset of the next chunk boundary to look at, for either of the above.
+    next_checkpoint = segment_start
+    while data_offset < data_len and data_offset < segment_stop:
+        chunk_start = data_offset
+        if chunk_start >= next_checkpoint:
+            if not recording:
+                recording = True
+                start = chunk_start
+                tracking = speculative is None
+            if tracking:
+                checkpoints.append((chunk_start, px_offset, (r, g, b, a), tuple(table)))
+                live_slots.append(0)
+                live_last.append(None)
+                current += 1
+                next_checkpoint = (
+                    chunk_start // PARALLEL_CHECKPOINT_INTERVAL + 1
+                ) * PARALLEL_CHECKPOINT_INTERVAL
+            else:
+                spec_index = bisect.bisect_left(spec_offsets, chunk_start, spec_index)
+                if spec_index == len(spec_offsets):
+                    next_checkpoint = data_len
+                elif spec_offsets[spec_index] > chunk_start:
+                    next_checkpoint = spec_offsets[spec_index]
+                else:
+                    spliced = _splice_segment(
+                        speculative,
+                        spec_index,
+                        start,
+                        px_offset,
+                        pixels,
+                        table,
+                        (r, g, b, a),
+                        px_base,
+                        w_h,
+                    )
+                    if spliced is not None:
+                        return spliced
+                    spec_index += 1
+                    next_checkpoint = (
+                        spec_offsets[spec_index]
+                        if spec_index < len(spec_offsets)
+                        else data_len
+                    )
+        kind, arg = opcode_table[qoidata[data_offset]]
+        data_offset += 1
+        run_length = 1
+        if kind is op_index:
+            r, g, b, a = table[arg]
+        elif kind is op_diff:
+            r = (r + arg[0]) % 256
+            g = (g + arg[1]) % 256
+            b = (b + arg[2]) % 256
+        elif kind is op_luma:
+            xy = qoidata[data_offset] if data_offset < data_len else 0
+            data_offset += 1
+            r = (r + ((xy >> 4) & 0x0F) - 8 + arg) % 256
+            g = (g + arg) % 256
+            b = (b + (xy & 0x0F) - 8 + arg) % 256
+        elif kind is op_rgba:
+            if data_offset + 4 <= data_len:
+                r, g, b, a = qoidata[data_offset : data_offset + 4]
+            else:
+                r, g, b, a = _read_padded(qoidata, data_offset, 4)
+            data_offset += 4
+        elif kind is op_run:
+            run_length = arg
+        else:
+            if data_offset + 3 <= data_len:
+                r, g, b = qoidata[data_offset : data_offset + 3]
+            else:
+                r, g, b = _read_padded(qoidata, data_offset, 3)
+            data_offset += 3
+        if tracking:
+            if live_last[current] is None:
+                live_last[current] = kind is not op_rgba and kind is not op_index
+            if kind is op_index:
+                # This read is the first access to the slot since all these checkpoints.
+                for j in range(untouched_since[arg], current + 1):
+                    live_slots[j] |= 1 << arg
+                untouched_since[arg] = current + 1
+        if kind is not op_run:
+            slot = (r * 3 + g * 5 + b * 7 + a * 11) % 64
+            table[slot] = (r, g, b, a)
+            if tracking:
+                untouched_since[slot] = current + 1
+                last_written[slot] = current
+        if not recording:
+            continue
+        # Same limit as in decode_all(). A speculative decode doesn't know px_base, so it may be off.
+        if px_base + px_offset + run_length > px_limit:
+            truncated = True
+            break
+        if px_offset < max_pixels:
+            if run_length == 1:
+                i = px_offset * 3
+                pixels[i] = r
+                pixels[i + 1] = g
+                pixels[i + 2] = b
+            else:
+                px_end = min(px_offset + run_length, max_pixels)
+                pixels[px_offset * 3 : px_end * 3] = bytes((r, g, b)) * (
+                    px_end - px_offset
+                )
+        px_offset += run_length
+    return Segment(
+        start=start,
+        stop=data_offset,
+        num_pixels=px_offset,
+        pixels=bytes(pixels[: 3 * min(px_offset, max_pixels)]),
+        checkpoints=checkpoints,
+        live_slots=live_slots,
+        live_last=live_last,
+        last_written=last_written,
+        table=tuple(table),
+        last=(r, g, b, a),
+        truncated=truncated,
+    )
+
+
+def _splice_segment(
+    speculative, j, start, px_offset, pixels, table, last, px_base, w_h
+):
+    """
+    Returns the exact Segment, if the speculative decode from its j-th checkpoint on is valid for this exact state,
+    otherwise None.
+    """
+    _, spec_px, spec_last, spec_table = speculative.checkpoints[j]
+    if speculative.truncated and px_base + px_offset != spec_px:
+        # Where exactly the limit hits depends on the absolute pixel position.
+        return None
+    # None means that no chunk follows, so "last" is part of the final state as-is.
+    if speculative.live_last[j] is not False and spec_last != last:
+        return None
+    live = speculative.live_slots[j]
+    for slot in range(64):
+        if (live >> slot) & 1 and table[slot] != spec_table[slot]:
+            return None
+    num_pixels = px_offset + speculative.num_pixels - spec_px
+    if not speculative.truncated and px_base + num_pixels > 3 * w_h:
+        return None
+    num_visible_before = min(px_offset, max(0, w_h - px_base))
+    num_visible_after = min(
+        speculative.num_pixels - spec_px, max(0, w_h - px_base - px_offset)
+    )
+    if 3 * (spec_px + num_visible_after) > len(speculative.pixels):
+        # The speculative decode didn't keep those pixels, because it didn't know they are visible.
+        return None
+    return Segment(
+        start=start,
+        stop=speculative.stop,
+        num_pixels=num_pixels,
+        pixels=bytes(pixels[: 3 * num_visible_before])
+        + speculative.pixels[3 * spec_px : 3 * (spec_px + num_visible_after)],
+        checkpoints=[],
+        live_slots=[],
+        live_last=[],
+        last_written=[],
+        table=tuple(
+            (
+                speculative.table[slot]
+                if speculative.last_written[slot] >= j
+                else table[slot]
+            )
+            for slot in range(64)
+        ),
+        last=speculative.last,
+        truncated=speculative.truncated,
+    )
+
+
+def decode_pixels_parallel(qoidata, w, h, executor=None, num_segments=None):
+    """
+    Same result as decode_pixels(), but decodes segments of the buffer speculatively in a process pool.
+
+    Each segment is first decoded from a guessed state (see _decode_segment). Then, going through the segments in
+    order, the exact state at the start of each segment is known, and the segment only needs to be decoded until
+    it agrees with the guess, which is usually immediately, or after a few bytes.
+    Pathological streams that never agree on the chunk alignment (e.g. QOI_OP_RGB chunks with 0xFE as color
+    components) degrade to a sequential decode, plus overhead.
+    """
+    qoidata = bytes(qoidata)
+    if executor is None:
+        with ProcessPoolExecutor() as executor:
+            return decode_pixels_parallel(qoidata, w, h, executor, num_segments)
+    if num_segments is None:
+        num_segments = os.cpu_count() or 1
+    num_segments = max(1, min(num_segments, len(qoidata) // PARALLEL_MIN_SEGMENT_BYTES))
+    bounds = [len(qoidata) * k // num_segments for k in range(num_segments)]
+    bounds.append(len(qoidata))
+    futures = [
+        executor.submit(_decode_segment, qoidata, w, h, bounds[k], bounds[k + 1])
+        for k in range(num_segments)
+    ]
+    w_h = w * h
+    pixels = bytearray(3 * w_h)
+    table = [(0, 0, 0, 0)] * 64
+    last = (0, 0, 0, 255)
+    data_offset = 0
+    px_offset = 0
+    for k, future in enumerate(futures):
+        if px_offset >= w_h:
+            # Anything afterwards is invisible anyway.
+            break
+        segment = _decode_segment(
+            qoidata,
+            w,
+            h,
+            data_offset,
+            bounds[k + 1],
+            (table, last),
+            px_offset,
+            speculative=future.result(),
+        )
+        num_visible = min(segment.num_pixels, w_h - px_offset)
+        pixels[3 * px_offset : 3 * (px_offset + num_visible)] = segment.pixels[
+            : 3 * num_visible
+        ]
+        data_offset = segment.stop
+        px_offset += segment.num_pixels
+        table = segment.table
+        last = segment.last
+        if segment.truncated:
+            break
+    for future in futures:
+        future.cancel()
+    if px_offset < w_h:
+        if VERBOSE:
+            print(f"Expect {w_h} pixels, got {px_offset} instead")
+            print(f"Padding with {w_h - px_offset} purple pixels?!?!")
+        pixels[px_offset * 3 :] = bytes(COL_PADDING) * (w_h - px_offset)
+    return pixels
+
+
 def decode_to_indices(qoidata, w, h):
     qoi_eater = QoiEater(w, h, qoidata)
     indices = []
@@ -167,13 +767,786 @@ def decode_to_indices(qoidata, w, h):
     return indices
 
 
+class IncrementalDecoder:
+    """
+    Keeps the decoded pixels of a buffer around, and after a write only re-decodes the part that actually changed.
+
+    Every CHECKPOINT_INTERVAL data bytes, the full QoiEater state at the first chunk boundary is remembered, along
+    with what the rest of the stream depends on: The table slots that get read before being overwritten, and whether
+    the next chunk reads "last". After a write, decoding restarts at the last checkpoint before the write, and stops
+    as soon as it hits a checkpoint where all of that agrees with the previous decode: Everything afterwards is
+    identical anyway. A new color in a slot that nobody reads doesn't keep it from getting back in sync.
+    Like decode_pixels(), it stops at the last visible pixel, so writes after that are free.
+    """
+
+    INITIAL_STATE = (0, 0, ((0, 0, 0, 0),) * 64, (0, 0, 0, 255))
+
+    def __init__(
+        self,
+        qoidata,
+        w,
+        h,
+        checkpoint_interval=CHECKPOINT_INTERVAL,
+        want_overlay=False,
+    ):
+        # No chunk may skip over an entire interval.
+        assert checkpoint_interval >= 8, checkpoint_interval
+        self.qoidata = qoidata
+        self.w = w
+        self.h = h
+        self.checkpoint_interval = checkpoint_interval
+        self.pixels = bytearray(bytes(COL_PADDING) * (w * h))
+        # Same as decode_all(..., want_overlay=True).overlay, kept up to date alongside the pixels.
+        self.overlay = bytearray(bytes(COL_PADDING) * (w * h)) if want_overlay else None
+        # Per checkpoint: The QoiEater state, a bitmask of the slots that get read before being overwritten
+        # afterwards, whether the next chunk reads "last" (None if there is none), and a bitmask of the slots
+        # accessed before the next checkpoint.
+        self.checkpoints = []
+        self.checkpoint_offsets = []
+        self.live_slots = []
+        self.live_last = []
+        self.touched = []
+        # Where decoding stopped: The pixel offset, and the data offset.
+        self.end_px = 0
+        self.end_offset = 0
+        self._decode_from(self.INITIAL_STATE, -1, ([], [], [], []), -1)
+
+    def update(self, offsets, qoidata=None):
+        """
+        Re-decodes after the bytes at the given offsets were written.
+        Returns the range (px_start, px_end) of pixels that might have changed.
+        """
+        if qoidata is not None:
+            self.qoidata = qoidata
+        offsets = sorted(offsets)
+        px_start, px_end = 0, 0
+        k = 0
+        # Each write gets its own chance to get back in sync. Later writes that the re-decode already went over
+        # are taken care of, and anything after where decoding stops is invisible.
+        while k < len(offsets) and offsets[k] < self.end_offset:
+            start, stop, resync_offset = self._update_at(offsets[k])
+            if px_start == px_end:
+                px_start, px_end = start, stop
+            elif start != stop:
+                px_start, px_end = min(px_start, start), max(px_end, stop)
+            k = bisect.bisect_left(offsets, resync_offset, k + 1)
+        return (px_start, px_end)
+
+    def _update_at(self, offset):
+        i = bisect.bisect_right(self.checkpoint_offsets, offset) - 1
+        state = self.checkpoints[i] if i >= 0 else self.INITIAL_STATE
+        old = (
+            self.checkpoints[i + 1 :],
+            self.live_slots[i + 1 :],
+            self.live_last[i + 1 :],
+            self.touched[i + 1 :],
+        )
+        del self.checkpoints[i + 1 :]
+        del self.checkpoint_offsets[i + 1 :]
+        del self.live_slots[i + 1 :]
+        del self.live_last[i + 1 :]
+        del self.touched[i + 1 :]
+        return self._decode_from(state, i, old, offset)
+
+    def _reopen_checkpoints(self, i):
+        """
+        Forgets everything that checkpoint i and before know about what comes after checkpoint i.
+        Returns, for each slot, the first checkpoint since which nobody accessed it.
+        """
+        untouched_since = [i + 1] * 64
+        if i < 0:
+            return untouched_since
+        self.live_slots[i] = 0
+        self.live_last[i] = None
+        self.touched[i] = 0
+        untouched_since = [i] * 64
+        open_slots = (1 << 64) - 1
+        k = i - 1
+        while open_slots and k >= 0:
+            closing = open_slots & self.touched[k]
+            if closing:
+                open_slots &= ~closing
+                for slot in range(64):
+                    if (closing >> slot) & 1:
+                        untouched_since[slot] = k + 1
+            self.live_slots[k] &= ~open_slots
+            k -= 1
+        if open_slots:
+            for slot in range(64):
+                if (open_slots >> slot) & 1:
+                    untouched_since[slot] = 0
+        return untouched_since
+
+    def _decode_from(self, state, i, old, resync_after):
+        interval = self.checkpoint_interval
+        w_h = self.w * self.h
+        px_limit = 3 * w_h
+        qoidata = self.qoidata
+        pixels = self.pixels
+        overlay = self.overlay
+        overlay_colors = OVERLAY_COLORS
+        opcode_table = OPCODE_TABLE
+        op_rgb = ChunkType.QOI_OP_RGB
+        op_rgba = ChunkType.QOI_OP_RGBA
+        op_index = ChunkType.QOI_OP_INDEX
+        op_diff = ChunkType.QOI_OP_DIFF
+        op_luma = ChunkType.QOI_OP_LUMA
+        op_run = ChunkType.QOI_OP_RUN
+        checkpoints = self.checkpoints
+        checkpoint_offsets = self.checkpoint_offsets
+        live_slots = self.live_slots
+        live_last = self.live_last
+        touched = self.touched
+        old_checkpoints, old_live_slots, old_live_last, _ = old
+        old_by_bucket = {
+            checkpoint[0] // interval: j for j, checkpoint in enumerate(old_checkpoints)
+        }
+        data_offset, px_offset, table, (r, g, b, a) = state
+        table = list(table)
+        px_start = min(px_offset, w_h)
+        untouched_since = self._reopen_checkpoints(i)
+        current = i
+        # Where the pixels moved for a shifted resync start, see below. The pixel limit mustn't hit before the last
+        # visible pixel, otherwise chunks might count differently after the move.
+        moved_start = None
+        can_shift = 3 * w_h >= w_h + 62
+        next_checkpoint = 0
+        if checkpoint_offsets:
+            next_checkpoint = (checkpoint_offsets[-1] // interval + 1) * interval
+        data_len = len(qoidata)
+        while data_offset < data_len and px_offset < w_h:
+            if data_offset >= next_checkpoint:
+                bucket = data_offset // interval
+                next_checkpoint = (bucket + 1) * interval
+                state = (data_offset, px_offset, tuple(table), (r, g, b, a))
+                j = old_by_bucket.get(bucket)
+                if (
+                    j is not None
+                    and data_offset > resync_after
+                    and self._is_in_sync(
+                        state, old_checkpoints[j], old_live_slots[j], old_live_last[j]
+                    )
+                ):
+                    old_px_offset = old_checkpoints[j][1]
+                    if (
+                        moved_start is not None
+                        and px_offset - old_px_offset != moved_shift
+                    ):
+                        # Another write changed the shift since the pixels got moved, so they are wrong now and
+                        # everything from here on needs to be decoded.
+                        old_by_bucket.clear()
+                    elif px_offset == old_px_offset:
+                        # Back in sync with the previous decode, so nothing after this point can have changed.
+                        self._resync(state, untouched_since, old, j)
+                        return (px_start, min(px_offset, w_h), data_offset)
+                    elif can_shift:
+                        # Same chunks as last time, so the same pixels, just shifted. Move what is still there.
+                        # If they moved backwards, some got overwritten already, so keep decoding until those
+                        # are done. Then only what used to be invisible is left to decode.
+                        if moved_start is None:
+                            src = max(px_offset, old_px_offset)
+                            moved_shift = px_offset - old_px_offset
+                            moved_start = src + moved_shift
+                            # Old pixels stay up to the old end. If they moved forwards, so did the end.
+                            self.end_px += max(moved_shift, 0)
+                            num_moved = max(0, w_h - max(src, moved_start))
+                            pixels[moved_start * 3 : (moved_start + num_moved) * 3] = (
+                                pixels[src * 3 : (src + num_moved) * 3]
+                            )
+                            if overlay is not None:
+                                overlay[
+                                    moved_start * 3 : (moved_start + num_moved) * 3
+                                ] = overlay[src * 3 : (src + num_moved) * 3]
+                        if px_offset >= moved_start:
+                            self._resync(state, untouched_since, old, j)
+                            i = len(checkpoints) - 1
+                            _, px_end, _ = self._decode_from(
+                                checkpoints[i], i, ([], [], [], []), -1
+                            )
+                            # Writes after this point still need to be looked at.
+                            return (px_start, px_end, data_offset)
+                checkpoints.append(state)
+                checkpoint_offsets.append(data_offset)
+                live_slots.append(0)
+                live_last.append(None)
+                touched.append(0)
+                current += 1
+            chunk_start = data_offset
+            kind, arg = opcode_table[qoidata[data_offset]]
+            data_offset += 1
+            run_length = 1
+            if live_last[current] is None:
+                live_last[current] = kind is not op_rgba and kind is not op_index
+            if kind is op_index:
+                since = untouched_since[arg]
+                if since <= current:
+                    # This read is the first access to the slot since all these checkpoints.
+                    for k in range(since, current + 1):
+                        live_slots[k] |= 1 << arg
+                    untouched_since[arg] = current + 1
+                touched[current] |= 1 << arg
+                r, g, b, a = table[arg]
+            elif kind is op_diff:
+                r = (r + arg[0]) % 256
+                g = (g + arg[1]) % 256
+                b = (b + arg[2]) % 256
+            elif kind is op_luma:
+                xy = qoidata[data_offset] if data_offset < data_len else 0
+                data_offset += 1
+                r = (r + ((xy >> 4) & 0x0F) - 8 + arg) % 256
+                g = (g + arg) % 256
+                b = (b + (xy & 0x0F) - 8 + arg) % 256
+            elif kind is op_rgb:
+                if data_offset + 3 <= data_len:
+                    r, g, b = qoidata[data_offset : data_offset + 3]
+                else:
+                    r, g, b = _read_padded(qoidata, data_offset, 3)
+                data_offset += 3
+            elif kind is op_rgba:
+                if data_offset + 4 <= data_len:
+                    r, g, b, a = qoidata[data_offset : data_offset + 4]
+                else:
+                    r, g, b, a = _read_padded(qoidata, data_offset, 4)
+                data_offset += 4
+            else:
+                run_length = arg
+            if kind is not op_run:
+                slot = (r * 3 + g * 5 + b * 7 + a * 11) % 64
+                table[slot] = (r, g, b, a)
+                untouched_since[slot] = current + 1
+                touched[current] |= 1 << slot
+            # Same limit as in decode():
+            if px_offset + run_length > px_limit:
+                break
+            px_end = min(px_offset + run_length, w_h)
+            pixels[px_offset * 3 : px_end * 3] = bytes((r, g, b)) * (px_end - px_offset)
+            if overlay is not None:
+                overlay[px_offset * 3 : px_end * 3] = overlay_colors[kind] * (
+                    px_end - px_offset
+                )
+            px_offset += run_length
+        # Decoded until the very end. If the stream got shorter, the rest is padding now.
+        new_end = min(px_offset, w_h)
+        old_end = min(self.end_px, w_h)
+        if new_end < old_end:
+            pixels[new_end * 3 : old_end * 3] = bytes(COL_PADDING) * (old_end - new_end)
+            if overlay is not None:
+                overlay[new_end * 3 : old_end * 3] = bytes(COL_PADDING) * (
+                    old_end - new_end
+                )
+        self.end_px = px_offset
+        self.end_offset = data_offset
+        return (px_start, max(new_end, old_end), data_offset)
+
+    @staticmethod
+    def _is_in_sync(state, old_state, old_live_slots, old_live_last):
+        # Everything after this point is the same as last time if these agree. Unread slots don't matter.
+        data_offset, px_offset, table, last = state
+        old_data_offset, old_px_offset, old_table, old_last = old_state
+        # The pixel offsets may differ, see _decode_from().
+        if data_offset != old_data_offset:
+            return False
+        if old_live_last and last != old_last:
+            return False
+        if table == old_table:
+            return True
+        for slot in range(64):
+            if (old_live_slots >> slot) & 1 and table[slot] != old_table[slot]:
+                return False
+        return True
+
+    def _resync(self, state, untouched_since, old, j):
+        """
+        Takes over the old checkpoints from j on, with the pixel offsets moved to where they are now.
+        Those that end up beyond the last visible pixel are dropped.
+        """
+        old_checkpoints, old_live_slots, old_live_last, old_touched = old
+        current = len(self.checkpoints) - 1
+        w_h = self.w * self.h
+        px_shift = state[1] - old_checkpoints[j][1]
+        # The slots that the rest of the stream reads are also read after the recomputed checkpoints,
+        # unless they got accessed in between.
+        live = old_live_slots[j]
+        for slot in range(64):
+            if (live >> slot) & 1:
+                for k in range(untouched_since[slot], current + 1):
+                    self.live_slots[k] |= 1 << slot
+        # The later checkpoints keep the new table entries until the slot gets touched.
+        table = state[2]
+        old_table = old_checkpoints[j][2]
+        pending = [slot for slot in range(64) if table[slot] != old_table[slot]]
+        checkpoints = [state]
+        for k in range(j + 1, len(old_checkpoints)):
+            later_state = old_checkpoints[k]
+            if px_shift != 0:
+                if later_state[1] + px_shift >= w_h:
+                    break
+                later_state = (later_state[0], later_state[1] + px_shift) + later_state[
+                    2:
+                ]
+            if pending:
+                pending = [
+                    slot for slot in pending if not (old_touched[k - 1] >> slot) & 1
+                ]
+            if pending:
+                later_table = list(later_state[2])
+                for slot in pending:
+                    later_table[slot] = table[slot]
+                later_state = later_state[:2] + (tuple(later_table),) + later_state[3:]
+            checkpoints.append(later_state)
+        self.checkpoints.extend(checkpoints)
+        self.checkpoint_offsets.extend(c[0] for c in checkpoints)
+        stop = j + len(checkpoints)
+        self.live_slots.extend(old_live_slots[j:stop])
+        self.live_last.extend(old_live_last[j:stop])
+        self.touched.extend(old_touched[j:stop])
+
+    def image(self):
+        return Image.frombytes("RGB", (self.w, self.h), bytes(self.pixels))
+
+
+class ImpactMap:
+    """
+    For every data offset: How many pixels the chunk at that offset owns (its "span"), and an estimate of how many
+    pixels a write there could change (its "reach"), assuming the write doesn't change the chunk's length.
+
+    A chunk's color propagates in two ways: Through "last" into the next chunk, if that is a QOI_OP_DIFF, QOI_OP_LUMA,
+    or QOI_OP_RUN, and through the table into the next QOI_OP_INDEX chunk that reads its slot before anyone overwrites
+    it. The reach follows both links transitively, starting at the chunk's first pixel. Only visible pixels count.
+    It's an estimate: A new color also lands in a different table slot, and nobody knows who reads that one.
+
+    Like IncrementalDecoder, it keeps checkpoints, and after a write only recomputes until it is back in sync.
+    Here, a checkpoint additionally remembers which chunk last wrote each table slot, and which chunks first read
+    each slot afterwards. So it is back in sync as soon as "last" and the slots that actually get read agree, just
+    like decode_pixels_parallel(). The reaches, and the heatmap brightness, are then only recomputed for the chunks
+    that changed, and for the chunks that link to those.
+    """
+
+    def __init__(self, qoidata, w, h, checkpoint_interval=CHECKPOINT_INTERVAL):
+        assert checkpoint_interval >= 8, checkpoint_interval
+        self.qoidata = qoidata
+        self.w = w
+        self.h = h
+        self.checkpoint_interval = checkpoint_interval
+        self.brightness_scale = 255 / math.log2(w * h + 1)
+        length = len(qoidata)
+        # For each byte: The data offset of the chunk it belongs to, or -1 if it isn't part of any decoded chunk.
+        self.chunk_of = array("i", [-1]) * length
+        # The rest is only meaningful at chunk starts.
+        self.chunk_length = array("B", bytes(length))
+        self.px_start = array("i", bytes(4 * length))
+        self.px_end = array("i", bytes(4 * length))
+        # The QOI_OP_INDEX chunk that reads what this chunk wrote into the table, or -1.
+        self.reader = array("i", [-1]) * length
+        # The other way around: For a QOI_OP_INDEX chunk, the chunk whose table write it reads, or -1.
+        self.read_from = array("i", [-1]) * length
+        # The pixel offset up to which a write to this chunk could make a difference.
+        self.reach_end = array("i", bytes(4 * length))
+        # For each byte: The reach of its chunk, on a logarithmic scale, as shown by heatmap().
+        self.brightness = bytearray(length)
+        # Where the decoded chunks end.
+        self.end = length
+        # Per checkpoint: (QoiEater state, table writers), the first reader of each slot afterwards (only for slots
+        # that get read before being overwritten), whether the next chunk depends on "last" (None if there is none),
+        # and a bitmask of the slots accessed before the next checkpoint.
+        self.checkpoints = []
+        self.checkpoint_offsets = []
+        self.first_readers = []
+        self.live_last = []
+        self.touched = []
+        self._compute_from(QoiEater(w, h, qoidata), [-1] * 64, -1, ([], [], [], []), -1)
+        self._update_reaches(0, len(self.chunk_of), set())
+
+    def update(self, offsets, qoidata=None):
+        """
+        Recomputes after the bytes at the given offsets were written.
+        Returns the range (start, stop) of data offsets whose chunks were recomputed.
+        """
+        if qoidata is not None:
+            self.qoidata = qoidata
+        if not offsets:
+            return (0, 0)
+        i = bisect.bisect_right(self.checkpoint_offsets, min(offsets)) - 1
+        qoi_eater = QoiEater(self.w, self.h, self.qoidata)
+        writers = [-1] * 64
+        if i >= 0:
+            state, writers = self.checkpoints[i]
+            qoi_eater.set_state(state)
+            writers = list(writers)
+        start = qoi_eater.data_offset
+        old = (
+            self.checkpoints[i + 1 :],
+            self.first_readers[i + 1 :],
+            self.live_last[i + 1 :],
+            self.touched[i + 1 :],
+        )
+        del self.checkpoints[i + 1 :]
+        del self.checkpoint_offsets[i + 1 :]
+        del self.first_readers[i + 1 :]
+        del self.live_last[i + 1 :]
+        del self.touched[i + 1 :]
+        dirty = set()
+        stop = self._compute_from(qoi_eater, writers, i, old, max(offsets), dirty)
+        self._update_reaches(start, stop, dirty)
+        return (start, stop)
+
+    def _reopen_checkpoints(self, i):
+        """
+        Forgets everything that checkpoint i and before know about what comes after checkpoint i.
+        Returns, for each slot, the first checkpoint since which nobody accessed it.
+        """
+        untouched_since = [i + 1] * 64
+        if i < 0:
+            return untouched_since
+        self.first_readers[i] = dict()
+        self.live_last[i] = None
+        self.touched[i] = 0
+        open_slots = (1 << 64) - 1
+        k = i
+        while open_slots and k >= 0:
+            if k < i:
+                open_slots &= ~self.touched[k]
+            first_readers = self.first_readers[k]
+            for slot in range(64):
+                if (open_slots >> slot) & 1:
+                    untouched_since[slot] = k
+                    first_readers.pop(slot, None)
+            k -= 1
+        return untouched_since
+
+    def _compute_from(self, qoi_eater, writers, i, old, resync_after, dirty=None):
+        interval = self.checkpoint_interval
+        w_h = self.w * self.h
+        qoidata = self.qoidata
+        chunk_of = self.chunk_of
+        reader = self.reader
+        read_from = self.read_from
+        first_readers = self.first_readers
+        live_last = self.live_last
+        touched = self.touched
+        old_checkpoints, old_first_readers, old_live_last, old_touched = old
+        old_by_bucket = {
+            checkpoint[0][0] // interval: j
+            for j, checkpoint in enumerate(old_checkpoints)
+        }
+        untouched_since = self._reopen_checkpoints(i)
+        current = i
+        last_bucket = -1
+        if self.checkpoints:
+            last_bucket = self.checkpoint_offsets[-1] // interval
+        while True:
+            offset = qoi_eater.data_offset
+            bucket = offset // interval
+            if bucket != last_bucket:
+                last_bucket = bucket
+                state = qoi_eater.get_state()
+                j = old_by_bucket.get(bucket)
+                if (
+                    j is not None
+                    and offset > resync_after
+                    and self._is_in_sync(
+                        state,
+                        old_checkpoints[j][0],
+                        old_first_readers[j],
+                        old_live_last[j],
+                    )
+                ):
+                    self._resync(state, writers, untouched_since, old, j, dirty)
+                    return offset
+                self.checkpoints.append((state, tuple(writers)))
+                self.checkpoint_offsets.append(offset)
+                first_readers.append(dict())
+                live_last.append(None)
+                touched.append(0)
+                current += 1
+            old_px_offset = qoi_eater.px_offset
+            chunk_type, rgba = qoi_eater.consume()
+            if chunk_type == ChunkType.NONE:
+                break
+            # Same limit as in decode():
+            if qoi_eater.px_offset > 3 * w_h:
+                qoi_eater.px_offset = old_px_offset
+                qoi_eater.data_offset = offset
+                break
+            length = qoi_eater.data_offset - offset
+            chunk_of[offset : offset + length] = array("i", [offset]) * length
+            self.chunk_length[offset] = length
+            self.px_start[offset] = old_px_offset
+            self.px_end[offset] = qoi_eater.px_offset
+            read_from[offset] = -1
+            if live_last[current] is None:
+                live_last[current] = chunk_type not in (
+                    ChunkType.QOI_OP_RGBA,
+                    ChunkType.QOI_OP_INDEX,
+                )
+            if chunk_type == ChunkType.QOI_OP_RUN:
+                # Everything else writes into the table, so its reader gets set below, or when back in sync.
+                reader[offset] = -1
+                continue
+            if chunk_type == ChunkType.QOI_OP_INDEX:
+                read_slot = qoidata[offset] & 0x3F
+                # This is the first access to the slot since all these checkpoints.
+                for k in range(untouched_since[read_slot], current + 1):
+                    first_readers[k][read_slot] = offset
+                untouched_since[read_slot] = current + 1
+                touched[current] |= 1 << read_slot
+                writer = writers[read_slot]
+                read_from[offset] = writer
+                if writer >= 0:
+                    reader[writer] = offset
+                    writers[read_slot] = -1
+                    if dirty is not None:
+                        dirty.add(writer)
+            slot = _hash_rgba(rgba)
+            untouched_since[slot] = current + 1
+            touched[current] |= 1 << slot
+            if writers[slot] >= 0:
+                # Overwritten before anyone read it.
+                reader[writers[slot]] = -1
+                if dirty is not None:
+                    dirty.add(writers[slot])
+            writers[slot] = offset
+        # Reached the end of the stream: Nobody reads the open slots anymore.
+        end = qoi_eater.data_offset
+        for writer in writers:
+            if writer >= 0:
+                reader[writer] = -1
+                if dirty is not None:
+                    dirty.add(writer)
+        chunk_of[end:] = array("i", [-1]) * (len(chunk_of) - end)
+        self.brightness[end:] = bytes(len(chunk_of) - end)
+        self.end = end
+        return len(chunk_of)
+
+    @staticmethod
+    def _is_in_sync(state, old_state, old_first_readers, old_live_last):
+        # Everything after this point is the same as last time if these agree. Unread slots don't matter.
+        data_offset, px_offset, table, last = state
+        old_data_offset, old_px_offset, old_table, old_last = old_state
+        if (data_offset, px_offset) != (old_data_offset, old_px_offset):
+            return False
+        if old_live_last and last != old_last:
+            return False
+        return all(table[slot] == old_table[slot] for slot in old_first_readers)
+
+    def _resync(self, state, writers, untouched_since, old, j, dirty):
+        old_checkpoints, old_first_readers, old_live_last, old_touched = old
+        current = len(self.checkpoints) - 1
+        first_readers = old_first_readers[j]
+        # The slots that are still open get read by the same chunks as last time, but maybe written by others.
+        for slot, writer in enumerate(writers):
+            next_reader = first_readers.get(slot, -1)
+            if writer >= 0:
+                self.reader[writer] = next_reader
+                dirty.add(writer)
+            if next_reader >= 0:
+                self.read_from[next_reader] = writer
+            if next_reader >= 0:
+                for k in range(untouched_since[slot], current + 1):
+                    self.first_readers[k][slot] = next_reader
+        # The later checkpoints keep the new table entries and writers until the slot gets touched.
+        (_, _, old_table, _), old_writers = old_checkpoints[j]
+        table = state[2]
+        pending = {
+            slot
+            for slot in range(64)
+            if (table[slot], writers[slot]) != (old_table[slot], old_writers[slot])
+        }
+        checkpoints = [(state, tuple(writers))]
+        for k in range(j + 1, len(old_checkpoints)):
+            for slot in list(pending):
+                if (old_touched[k - 1] >> slot) & 1:
+                    pending.discard(slot)
+            later_state, later_writers = old_checkpoints[k]
+            if pending:
+                later_table = list(later_state[2])
+                later_writers = list(later_writers)
+                for slot in pending:
+                    later_table[slot] = table[slot]
+                    later_writers[slot] = writers[slot]
+                later_state = later_state[:2] + (tuple(later_table),) + later_state[3:]
+                later_writers = tuple(later_writers)
+            checkpoints.append((later_state, later_writers))
+        self.checkpoints.extend(checkpoints)
+        self.checkpoint_offsets.extend(c[0][0] for c in checkpoints)
+        self.first_readers.extend(old_first_readers[j:])
+        self.live_last.extend(old_live_last[j:])
+        self.touched.extend(old_touched[j:])
+
+    def _predecessor(self, chunk):
+        # The chunk whose color this chunk directly depends on, or -1. There is at most one.
+        first_byte = self.qoidata[chunk]
+        if OPCODE_TABLE[first_byte][0] == ChunkType.QOI_OP_INDEX:
+            return self.read_from[chunk]
+        if chunk > 0 and BUILDS_ON_LAST[first_byte]:
+            return self.chunk_of[chunk - 1]
+        return -1
+
+    def _update_reach(self, chunk):
+        # Returns whether the reach changed.
+        w_h = self.w * self.h
+        end = self.px_end[chunk]
+        # The chunks that directly depend on the color of this chunk.
+        following = chunk + self.chunk_length[chunk]
+        if (
+            following < len(self.chunk_of)
+            and self.chunk_of[following] == following
+            and BUILDS_ON_LAST[self.qoidata[following]]
+        ):
+            end = max(end, self.reach_end[following])
+        if self.reader[chunk] >= 0:
+            end = max(end, self.reach_end[self.reader[chunk]])
+        # Only visible pixels count, so changes beyond those don't need to propagate.
+        end = min(end, w_h)
+        reach = end - min(self.px_start[chunk], w_h)
+        length = self.chunk_length[chunk]
+        value = int(math.log2(reach + 1) * self.brightness_scale)
+        self.brightness[chunk : chunk + length] = bytes((value,)) * length
+        if end == self.reach_end[chunk]:
+            return False
+        self.reach_end[chunk] = end
+        return True
+
+    def _update_reaches(self, start, stop, dirty):
+        """
+        Recomputes the reach of all chunks in [start, stop), and of the dirty chunks before that.
+        Every link points forward, so going backwards resolves them all, and that only needs to continue while
+        something changes.
+        """
+        chunk_of = self.chunk_of
+        todo = [-chunk for chunk in dirty if chunk < start]
+        if start > 0 and chunk_of[start - 1] >= 0:
+            # Its follower might have changed its type.
+            todo.append(-chunk_of[start - 1])
+        offset = min(stop, self.end) - 1
+        while offset >= start:
+            chunk = chunk_of[offset]
+            if chunk < 0:
+                offset -= 1
+                continue
+            self._update_reach(chunk)
+            predecessor = self._predecessor(chunk)
+            if 0 <= predecessor < start:
+                todo.append(-predecessor)
+            offset = chunk - 1
+        heapq.heapify(todo)
+        previous = None
+        while todo:
+            chunk = -heapq.heappop(todo)
+            if chunk == previous or chunk_of[chunk] != chunk:
+                continue
+            previous = chunk
+            if self._update_reach(chunk):
+                predecessor = self._predecessor(chunk)
+                if predecessor >= 0:
+                    heapq.heappush(todo, -predecessor)
+
+    def span(self, offset):
+        chunk = self.chunk_of[offset]
+        if chunk < 0:
+            return 0
+        w_h = self.w * self.h
+        return min(self.px_end[chunk], w_h) - min(self.px_start[chunk], w_h)
+
+    def reach(self, offset):
+        chunk = self.chunk_of[offset]
+        if chunk < 0:
+            return 0
+        w_h = self.w * self.h
+        return min(self.reach_end[chunk], w_h) - min(self.px_start[chunk], w_h)
+
+    def spans(self):
+        """Returns the span of every data offset, as array('i')."""
+        return array("i", (self.span(offset) for offset in range(len(self.chunk_of))))
+
+    def reaches(self):
+        """Returns the reach of every data offset, as array('i')."""
+        return array("i", (self.reach(offset) for offset in range(len(self.chunk_of))))
+
+    def heatmap(self, width=1024):
+        """Returns the reach of each data offset as a grayscale image, row by row, on a logarithmic scale."""
+        height = -(-len(self.brightness) // width)
+        values = bytes(self.brightness) + bytes(width * height - len(self.brightness))
+        return Image.frombytes("L", (width, height), values)
+
+
+def diff_pixels(old_pixels, new_pixels, w, h):
+    """
+    Compares two raw RGB buffers of the same size.
+    Returns the number of changed pixels, and their bounding box (x0, y0, x1, y1) with exclusive x1/y1, or None.
+    """
+    old_pixels = memoryview(old_pixels)
+    new_pixels = memoryview(new_pixels)
+    row_length = 3 * w
+    num_changed = 0
+    x0, y0, x1, y1 = w, h, 0, 0
+    for y in range(h):
+        row_start = y * row_length
+        old_row = old_pixels[row_start : row_start + row_length]
+        new_row = new_pixels[row_start : row_start + row_length]
+        if old_row == new_row:
+            continue
+        y0 = min(y0, y)
+        y1 = y + 1
+        for x in range(w):
+            if old_row[3 * x : 3 * x + 3] != new_row[3 * x : 3 * x + 3]:
+                num_changed += 1
+                x0 = min(x0, x)
+                x1 = max(x1, x + 1)
+    if num_changed == 0:
+        return (0, None)
+    return (num_changed, (x0, y0, x1, y1))
+
+
+def encode_header(w, h, channels=3, colorspace=0):
+    return QOI_HEADER_STRUCT.pack(QOI_MAGIC, w, h, channels, colorspace)
+
+
+def parse_header(qoifile):
+    """
+    Validates the header and end marker of a complete QOI file.
+    Returns the QoiHeader, and the chunk data in between as a memoryview, without copying anything.
+    The memoryview is writable if qoifile is, e.g. a bytearray.
+    """
+    qoifile = memoryview(qoifile)
+    if len(qoifile) < QOI_HEADER_STRUCT.size + len(QOI_END_MARKER):
+        raise ValueError(f"Too short for a QOI file: {len(qoifile)} bytes")
+    magic, w, h, channels, colorspace = QOI_HEADER_STRUCT.unpack_from(qoifile)
+    if magic != QOI_MAGIC:
+        raise ValueError(f"Not a QOI file, magic is {magic!r}")
+    if w == 0 or h == 0:
+        raise ValueError(f"Invalid dimensions {w}x{h}")
+    if channels not in (3, 4):
+        raise ValueError(f"Invalid number of channels {channels}")
+    if colorspace not in (0, 1):
+        raise ValueError(f"Invalid colorspace {colorspace}")
+    if qoifile[-len(QOI_END_MARKER) :] != QOI_END_MARKER:
+        raise ValueError("Missing end marker")
+    body = qoifile[QOI_HEADER_STRUCT.size : -len(QOI_END_MARKER)]
+    return QoiHeader(w, h, channels, colorspace), body
+
+
+def write_file(fp, qoidata, w, h, channels=3, colorspace=0):
+    """Writes header, chunk data, and end marker to the file-like object, without concatenating them first."""
+    fp.write(encode_header(w, h, channels, colorspace))
+    fp.write(qoidata)
+    fp.write(QOI_END_MARKER)
+
+
+def assemble_file(qoidata, w, h, channels=3, colorspace=0):
+    """Returns the complete QOI file as bytes. The chunk data (any buffer, e.g. an mmap) is copied exactly once."""
+    return b"".join(
+        [encode_header(w, h, channels, colorspace), qoidata, QOI_END_MARKER]
+    )
+
+
 def run(qoifile, pngfile):
     with open(qoifile, "rb") as fp:
         all_qoidata = fp.read()
-    qoidata = all_qoidata[14:-8]  # Skip header, skip footer
-    img = decode(qoidata, 512, 512)
+    header, qoidata = parse_header(all_qoidata)
+    img = decode_fast(qoidata, header.width, header.height)
     img.save(pngfile, "png")
-    indices = decode_to_indices(qoidata, 512, 512)
+    indices = decode_to_indices(qoidata, header.width, header.height)
     print(indices[:50])
 
 
@@ -1,3 +1,15 @@
 TOKEN = "1111111111:AAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAA"
 OWNER_ID = 123456789
 CHANNEL_ID = -1001234567890
+# Optional: Serve /canvas.qoi, /canvas.png, /indices, and /changes?since=VERSION over HTTP.
+# HTTP_PORT = 8080
+# Optional: Log all metrics every so many seconds, and/or dump a cProfile of every frame render into a directory.
+# METRICS_LOG_SECONDS = 600
+# PROFILE_DIR = "profiles"
+# Optional: Attach a third image to every post, showing which chunk type produced each pixel.
+# POST_OVERLAY = True
+# Optional: More canvases next to the main one, each with its own files (e.g. practice_state.json), and channel.
+# Users write there by putting the name in front, like "practice 1234 56".
+# CANVASES = [
+#     dict(name="practice", width=64, height=64, cooldown_seconds=5, channel_id=-1001234567891),
+# ]
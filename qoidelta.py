@@ -0,0 +1,153 @@
+#!/usr/bin/env python3
+
+from collections import namedtuple
+import hashlib
+import struct
+import sys
+
+import myqoi
+
+DELTA_MAGIC = b"qoid"
+# magic, base_version, version, width, height, num_records, base_hash, hash
+DELTA_HEADER_STRUCT = struct.Struct("<4sQQIII16s16s")
+# offset into the chunk data, old value, new value
+DELTA_RECORD_STRUCT = struct.Struct("<IBB")
+
+DeltaHeader = namedtuple(
+    "DeltaHeader",
+    ["base_version", "version", "width", "height", "num_records", "base_hash", "hash"],
+)
+DeltaRecord = namedtuple("DeltaRecord", ["offset", "old", "new"])
+
+
+def hash_file(qoi_file):
+    return hashlib.blake2b(qoi_file, digest_size=16).digest()
+
+
+def make_delta(base_version, base_file, version, qoi_file, offsets):
+    """
+    Returns the binary delta that turns the QOI file base_file (at base_version) into qoi_file (at version).
+    `offsets` must contain at least every offset into the chunk data that was written in between,
+    e.g. as read from the history. Offsets that ended up with their old value again are left out.
+    """
+    base_header, base_data = myqoi.parse_header(base_file)
+    header, data = myqoi.parse_header(qoi_file)
+    assert base_header == header, (base_header, header)
+    records = [
+        DELTA_RECORD_STRUCT.pack(offset, base_data[offset], data[offset])
+        for offset in sorted(offsets)
+        if base_data[offset] != data[offset]
+    ]
+    head = DELTA_HEADER_STRUCT.pack(
+        DELTA_MAGIC,
+        base_version,
+        version,
+        header.width,
+        header.height,
+        len(records),
+        hash_file(base_file),
+        hash_file(qoi_file),
+    )
+    return b"".join([head] + records)
+
+
+def parse_delta(delta):
+    """Returns the DeltaHeader, and the list of DeltaRecords."""
+    if len(delta) < DELTA_HEADER_STRUCT.size:
+        raise ValueError(f"Too short for a delta: {len(delta)} bytes")
+    magic, *fields = DELTA_HEADER_STRUCT.unpack_from(delta)
+    if magic != DELTA_MAGIC:
+        raise ValueError(f"Not a delta, magic is {magic!r}")
+    header = DeltaHeader(*fields)
+    expected_length = (
+        DELTA_HEADER_STRUCT.size + header.num_records * DELTA_RECORD_STRUCT.size
+    )
+    if len(delta) != expected_length:
+        raise ValueError(
+            f"Delta with {header.num_records} records should be {expected_length} bytes, not {len(delta)}"
+        )
+    records = [
+        DeltaRecord(*record)
+        for record in DELTA_RECORD_STRUCT.iter_unpack(
+            memoryview(delta)[DELTA_HEADER_STRUCT.size :]
+        )
+    ]
+    return header, records
+
+
+def apply_delta(qoi_file, delta):
+    """
+    Returns the QOI file after applying the delta to it.
+    Raises ValueError if the delta doesn't belong to this file, or the result isn't what the delta promised.
+    """
+    header, records = parse_delta(delta)
+    if hash_file(qoi_file) != header.base_hash:
+        raise ValueError(
+            f"Delta {header.base_version}..{header.version} belongs to a different base file"
+        )
+    qoi_file = bytearray(qoi_file)
+    qoi_header, data = myqoi.parse_header(qoi_file)
+    if (qoi_header.width, qoi_header.height) != (header.width, header.height):
+        raise ValueError(
+            f"Delta is for {header.width}x{header.height}, not {qoi_header.width}x{qoi_header.height}"
+        )
+    for record in records:
+        if record.offset >= len(data) or data[record.offset] != record.old:
+            raise ValueError(f"Delta doesn't match the base file at {record.offset}")
+        data[record.offset] = record.new
+    qoi_file = bytes(qoi_file)
+    if hash_file(qoi_file) != header.hash:
+        raise ValueError(
+            f"Applying delta {header.base_version}..{header.version} gave the wrong result"
+        )
+    return qoi_file
+
+
+def apply_deltas(qoi_file, deltas):
+    """Applies the deltas in order, checking that they form an unbroken chain. Returns the file and its version."""
+    version = None
+    for delta in deltas:
+        header, _ = parse_delta(delta)
+        if version is not None and header.base_version != version:
+            raise ValueError(
+                f"Gap in the deltas: {version} is followed by {header.base_version}..{header.version}"
+            )
+        qoi_file = apply_delta(qoi_file, delta)
+        version = header.version
+    return qoi_file, version
+
+
+def _read(path):
+    with open(path, "rb") as fp:
+        return fp.read()
+
+
+def run(command, base_path, delta_paths, out_path):
+    qoi_file, version = apply_deltas(
+        _read(base_path), [_read(path) for path in delta_paths]
+    )
+    if command == "apply":
+        with open(out_path, "wb") as fp:
+            fp.write(qoi_file)
+        print(f"Wrote version {version} to {out_path}")
+    elif command == "verify":
+        if qoi_file != _read(out_path):
+            print(f"MISMATCH: version {version} differs from {out_path}")
+            exit(1)
+        print(f"OK: version {version} matches {out_path}")
+    else:
+        raise ValueError(f"Unknown command {command}")
+
+
+if __name__ == "__main__":
+    if len(sys.argv) < 5 or sys.argv[1] not in ["apply", "verify"]:
+        print(
+            f"USAGE: {sys.argv[0]} apply base.qoi delta.qoidelta [...] outfile.qoi",
+            file=sys.stderr,
+        )
+        print(
+            f"       {sys.argv[0]} verify base.qoi delta.qoidelta [...] expected.qoi",
+            file=sys.stderr,
+        )
+        exit(1)
+    run(sys.argv[1], sys.argv[2], sys.argv[3:-1], sys.argv[-1])
@@ -0,0 +1,119 @@
+#!/bin/false
+# This is a library.
+
+import heapq
+import os
+import time
+
+
+class RateLimiter:
+    """
+    Tracks the time of each user's last write (or the end of their ban), and keeps count of old, current, and
+    banned users, so that the statistics don't need to walk over all users.
+
+    Users whose last write is ancient get archived: They are dropped from the hot `users_times` dict (which gets
+    persisted on every commit), and only remembered by ID in an append-only archive file.
+    """
+
+    def __init__(self, users_times, archive_path, timeout_seconds, ancient_seconds):
+        self.users_times = users_times
+        self.archive_path = archive_path
+        self.timeout_seconds = timeout_seconds
+        self.ancient_seconds = ancient_seconds
+        self.archived = set()
+        if os.path.exists(archive_path):
+            with open(archive_path) as fp:
+                # Note that the empty string is a valid user ID, see Store.force_null_byte.
+                self.archived = {line.rstrip("\n") for line in fp}
+        # Users may have come back after being archived.
+        self.archived -= users_times.keys()
+        self.newly_archived = []
+        self.num_current = 0
+        self.banned = set()
+        # Time-ordered (time, user_id, value) events at which some user changes category.
+        # Events of users that wrote again in the meantime are stale, and simply skipped.
+        self.events = []
+        now = time.time()
+        for user_id, value in users_times.items():
+            self._add(user_id, value, now)
+
+    def _add(self, user_id, value, now):
+        if value > now:
+            self.banned.add(user_id)
+            # Ban ends.
+            heapq.heappush(self.events, (value, user_id, value))
+        else:
+            self.num_current += 1
+        # Last write becomes ancient.
+        heapq.heappush(self.events, (value + self.ancient_seconds, user_id, value))
+
+    def _remove(self, user_id):
+        if user_id in self.banned:
+            self.banned.remove(user_id)
+        else:
+            self.num_current -= 1
+
+    def expire(self, now):
+        while self.events and self.events[0][0] < now:
+            event_time, user_id, value = heapq.heappop(self.events)
+            if self.users_times.get(user_id) != value:
+                continue
+            if event_time == value:
+                if user_id in self.banned:
+                    self.banned.remove(user_id)
+                    self.num_current += 1
+            else:
+                self._remove(user_id)
+                del self.users_times[user_id]
+                self.archived.add(user_id)
+                self.newly_archived.append(user_id)
+
+    def set_time(self, user_id, value, now):
+        self.expire(now)
+        old_value = self.users_times.get(user_id)
+        if old_value == value:
+            return
+        if old_value is not None:
+            self._remove(user_id)
+        else:
+            self.archived.discard(user_id)
+        self.users_times[user_id] = value
+        self._add(user_id, value, now)
+        # In case the new value is already ancient, e.g. after a reset:
+        self.expire(now)
+
+    # number of seconds left (negative if successful, positive otherwise)
+    def try_write(self, user_id, now) -> float:
+        last_write = self.users_times.get(user_id)
+        if last_write is not None:
+            remaining_wait = last_write + self.timeout_seconds - now
+            if remaining_wait > 0.05:
+                if remaining_wait < 60:
+                    # Punish users for being too eager. Effectively reset the timer to 60 seconds.
+                    self.set_time(user_id, now, now)
+                return remaining_wait
+        self.set_time(user_id, now, now)
+        return -1
+
+    def stats(self, now):
+        self.expire(now)
+        return dict(
+            old=len(self.archived), current=self.num_current, banned=len(self.banned)
+        )
+
+    def take_newly_archived(self):
+        newly_archived = self.newly_archived
+        self.newly_archived = []
+        return newly_archived
+
+    # Can run in a background thread, as long as it is given the result of take_newly_archived().
+    # Returns the number of bytes appended.
+    def write_archive(self, newly_archived):
+        if not newly_archived:
+            return 0
+        lines = "".join(f"{user_id}\n" for user_id in newly_archived)
+        with open(self.archive_path, "a") as fp:
+            fp.write(lines)
+            fp.flush()
+            os.fsync(fp.fileno())
+        return len(lines.encode())
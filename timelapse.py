@@ -0,0 +1,172 @@
+#!/usr/bin/env python3
+
+import os
+import struct
+import sys
+
+import historylog
+import myqoi
+
+# Size of the main canvas. Other canvases are given with --width and --height.
+WIDTH = 512
+HEIGHT = 512
+# Number of history records between two keyframes. Restoring any point in time never replays more than that.
+KEYFRAME_INTERVAL = 65536
+KEYFRAME_HEADER = struct.Struct("<Q")
+
+
+class Replay:
+    """
+    Rebuilds the canvas at any point of the history.
+
+    Every KEYFRAME_INTERVAL records, a full copy of the canvas is stored in a keyframe file next to the history.
+    The keyframes are only a cache: They can always be regenerated from the history alone.
+    """
+
+    def __init__(self, history, keyframes_path, w=WIDTH, h=HEIGHT):
+        self.history = history
+        self.w = w
+        self.h = h
+        self.length = 4 * w * h
+        self.keyframe_size = KEYFRAME_HEADER.size + self.length
+        self.keyframes_fp = open(keyframes_path, "a+b")
+        size = os.fstat(self.keyframes_fp.fileno()).st_size
+        if size % self.keyframe_size != 0:
+            # Torn keyframe at the end, just drop it and recompute it later.
+            self.keyframes_fp.truncate(size - size % self.keyframe_size)
+        self.num_keyframes = size // self.keyframe_size
+
+    def _read_keyframe(self, k):
+        self.keyframes_fp.flush()
+        raw = os.pread(
+            self.keyframes_fp.fileno(), self.keyframe_size, k * self.keyframe_size
+        )
+        (history_index,) = KEYFRAME_HEADER.unpack_from(raw)
+        assert history_index == k * KEYFRAME_INTERVAL, (history_index, k)
+        return bytearray(raw[KEYFRAME_HEADER.size :])
+
+    def _append_keyframe(self, history_index, canvas):
+        self.keyframes_fp.write(KEYFRAME_HEADER.pack(history_index))
+        self.keyframes_fp.write(canvas)
+        self.num_keyframes += 1
+
+    def update_keyframes(self):
+        """Makes sure that all keyframes up to the current end of the history exist."""
+        needed = len(self.history) // KEYFRAME_INTERVAL + 1
+        if self.num_keyframes >= needed:
+            return
+        if self.num_keyframes == 0:
+            canvas = bytearray(self.length)
+            self._append_keyframe(0, canvas)
+        else:
+            canvas = self._read_keyframe(self.num_keyframes - 1)
+        history_index = (self.num_keyframes - 1) * KEYFRAME_INTERVAL
+        while self.num_keyframes < needed:
+            stop = history_index + KEYFRAME_INTERVAL
+            for record in self.history.read(history_index, stop):
+                canvas[record.index] = record.value
+            history_index = stop
+            self._append_keyframe(history_index, canvas)
+        self.keyframes_fp.flush()
+        os.fsync(self.keyframes_fp.fileno())
+
+    def canvas_at_index(self, history_index):
+        """Returns the canvas after the first history_index writes."""
+        history_index = max(0, min(history_index, len(self.history)))
+        self.update_keyframes()
+        k = history_index // KEYFRAME_INTERVAL
+        canvas = self._read_keyframe(k)
+        for record in self.history.read(k * KEYFRAME_INTERVAL, history_index):
+            canvas[record.index] = record.value
+        return canvas
+
+    def index_at_time(self, timestamp):
+        """Returns the number of writes that happened at or before the given time."""
+        lo, hi = 0, len(self.history)
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if self.history[mid].time <= timestamp:
+                lo = mid + 1
+            else:
+                hi = mid
+        return lo
+
+    def canvas_at_time(self, timestamp):
+        return self.canvas_at_index(self.index_at_time(timestamp))
+
+    def frames(self, step, start=0, stop=None):
+        """
+        Yields (history_index, image) every `step` writes, from start to stop (inclusive).
+        Replays sequentially, and only re-decodes the part of the image that actually changed.
+        """
+        if stop is None or stop > len(self.history):
+            stop = len(self.history)
+        canvas = self.canvas_at_index(start)
+        decoder = myqoi.IncrementalDecoder(canvas, self.w, self.h)
+        yield (start, decoder.image())
+        history_index = start
+        while history_index < stop:
+            next_index = min(history_index + step, stop)
+            offsets = set()
+            for record in self.history.read(history_index, next_index):
+                canvas[record.index] = record.value
+                offsets.add(record.index)
+            decoder.update(offsets)
+            history_index = next_index
+            yield (history_index, decoder.image())
+
+
+def export_pngs(replay, step, outdir):
+    os.makedirs(outdir, exist_ok=True)
+    for history_index, img in replay.frames(step):
+        img.save(os.path.join(outdir, f"frame_{history_index:09}.png"), "png")
+
+
+def export_apng(replay, step, outfile, frame_duration_ms=100):
+    # Note that Pillow keeps all frames in memory while writing an APNG. For very long timelapses, prefer export_pngs.
+    frames = [img for _, img in replay.frames(step)]
+    frames[0].save(
+        outfile,
+        "png",
+        save_all=True,
+        append_images=frames[1:],
+        duration=frame_duration_ms,
+    )
+
+
+def run(history_path, command, arg, outpath, w=WIDTH, h=HEIGHT):
+    history = historylog.HistoryLog(history_path, readonly=True)
+    replay = Replay(history, history_path + ".keyframes", w, h)
+    if command == "at":
+        canvas = replay.canvas_at_time(float(arg))
+        if outpath.endswith(".qoi"):
+            with open(outpath, "wb") as fp:
+                myqoi.write_file(fp, canvas, replay.w, replay.h)
+        else:
+            myqoi.decode_fast(canvas, replay.w, replay.h).save(outpath, "png")
+    elif command == "lapse":
+        if outpath.endswith(".png") or outpath.endswith(".apng"):
+            export_apng(replay, int(arg), outpath)
+        else:
+            export_pngs(replay, int(arg), outpath)
+    else:
+        raise ValueError(f"Unknown command {command}")
+
+
+if __name__ == "__main__":
+    args = sys.argv[1:]
+    size = dict(width=WIDTH, height=HEIGHT)
+    while len(args) >= 2 and args[0] in ["--width", "--height"]:
+        size[args[0][2:]] = int(args[1])
+        args = args[2:]
+    if len(args) != 4 or args[1] not in ["at", "lapse"]:
+        print(
+            f"USAGE: {sys.argv[0]} [--width W --height H] history.bin at UNIX_TIMESTAMP {{outfile.png,outfile.qoi}}",
+            file=sys.stderr,
+        )
+        print(
+            f"       {sys.argv[0]} [--width W --height H] history.bin lapse EVERY_N_WRITES {{outdir/,outfile.apng}}",
+            file=sys.stderr,
+        )
+        exit(1)
+    run(*args, size["width"], size["height"])